@@ -1,27 +1,374 @@
-import copy
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import itertools
+import json
+import logging
+import re
 import sqlite3
 import os
 import os.path
+import threading
+import time
+import warnings
 
 
+class _Deferred(object):
+
+    def __repr__(self):
+        return '<deferred>'
+
+
+# value of columns left out of a projection, loaded on first get_value()
+_DEFERRED = _Deferred()
+
+
+@contextlib.contextmanager
+def _single_connection(conn):
+    yield conn
+
+
+def _next_batch(iterator, size):
+    return list(itertools.islice(iterator, size))
+
+
+_scan_connections = dict()
+
+
+def _scan_partition(model, database_path, fn, first, last, where, params, records):
+    # runs in a worker process of EdgeModel.parallel_scan with one read-only connection per process
+    conn = _scan_connections.get(database_path)
+    if conn is None:
+        conn = sqlite3.connect('file:' + database_path + '?mode=ro', uri=True)
+        _scan_connections[database_path] = conn
+    model._setup()
+    sql = model._SQL_SELECT + ' WHERE rowid BETWEEN ? AND ?'
+    if where is not None:
+        sql += ' AND (' + where + ')'
+    rows = conn.execute(sql + ';', [first, last] + list(params)).fetchall()
+    return fn(model._materialize(rows, records))
+
+
+def _text_converter(field):
+    # CSV cells are text, numeric fields convert them; export writes NULL as an empty cell, so empty cells
+    # are read back as NULL except for NotNull text fields
+    if isinstance(field, IntegerField):
+        return lambda value: int(value) if value != '' else None
+    if isinstance(field, RealField):
+        return lambda value: float(value) if value != '' else None
+    if field.property(PT.NotNull) is True:
+        return lambda value: value
+    return lambda value: value if value != '' else None
+
+
+def _open_file(path_or_file, mode):
+    # paths are opened (and closed by the caller), file objects are used as they are
+    if isinstance(path_or_file, str):
+        return open(path_or_file, mode, newline='', encoding='utf-8')
+    return path_or_file
+
+
+def _resolve_future(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class ObjectCache(object):
+
+    def __init__(self, max_size=1024):
+        assert max_size > 0
+        self.__max_size = max_size
+        self.__rows = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model, keys):
+        with self.__lock:
+            row = self.__rows.get((model, keys))
+            if row is None:
+                self.misses += 1
+                return None
+            self.__rows.move_to_end((model, keys))
+            self.hits += 1
+            return row
+
+    def put(self, model, keys, row):
+        with self.__lock:
+            self.__rows[(model, keys)] = row
+            self.__rows.move_to_end((model, keys))
+            while len(self.__rows) > self.__max_size:
+                self.__rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, model, keys=None):
+        with self.__lock:
+            if keys is not None:
+                self.__rows.pop((model, keys), None)
+                return
+            for k in [k for k in self.__rows if k[0] is model]:
+                del self.__rows[k]
+
+    def clear(self):
+        with self.__lock:
+            self.__rows.clear()
+
+    def stats(self):
+        return {'size': len(self.__rows), 'max_size': self.__max_size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+QueryEvent = collections.namedtuple('QueryEvent', ['shape', 'sql', 'elapsed', 'rows'])
+
+
+class QueryInstrumentation(object):
+
+    # histogram bucket upper bounds in milliseconds
+    BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 50.0, 100.0, 500.0, 1000.0, float('inf'))
+    _LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    _SPACES = re.compile(r'\s+')
+
+    def __init__(self, callback=None, slow_query_ms=None, logger=None):
+        self.callback = callback
+        self.slow_query_ms = slow_query_ms
+        self.logger = logger if logger is not None else logging.getLogger('EdgeModel')
+        self.commits = 0
+        self.__shapes = dict()
+        self.__stats = dict()
+        self.__lock = threading.Lock()
+
+    def shape(self, sql):
+        # SQL text with literals replaced by ?, the model's _SQL_* templates are already shapes
+        shape = self.__shapes.get(sql)
+        if shape is None:
+            shape = self._SPACES.sub(' ', self._LITERALS.sub('?', sql)).strip()
+            if len(self.__shapes) < 4096:
+                self.__shapes[sql] = shape
+        return shape
+
+    def record(self, sql, elapsed, rows):
+        shape = self.shape(sql)
+        ms = elapsed * 1000.0
+        with self.__lock:
+            stats = self.__stats.get(shape)
+            if stats is None:
+                stats = {'count': 0, 'total_time': 0.0, 'max_time': 0.0, 'rows': 0,
+                         'histogram': [0] * len(self.BUCKETS)}
+                self.__stats[shape] = stats
+            stats['count'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['rows'] += max(rows, 0)
+            for i, bound in enumerate(self.BUCKETS):
+                if ms <= bound:
+                    stats['histogram'][i] += 1
+                    break
+        if self.slow_query_ms is not None and ms >= self.slow_query_ms:
+            self.logger.warning('slow query %.3f ms, %d rows: %s', ms, rows, sql)
+        if self.callback is not None:
+            self.callback(QueryEvent(shape, sql, elapsed, rows))
+
+    def stats(self):
+        with self.__lock:
+            return dict((shape, dict(stats, histogram=list(stats['histogram'])))
+                        for shape, stats in self.__stats.items())
+
+    def reset(self):
+        with self.__lock:
+            self.__stats.clear()
+            self.commits = 0
+
+
+class _InstrumentedCursor(object):
+    # times execute plus fetches and reports once the rows have been read
+
+    def __init__(self, instrumentation, cursor, sql, elapsed):
+        self._instrumentation = instrumentation
+        self._cursor = cursor
+        self._sql = sql
+        self._elapsed = elapsed
+        self._rows = 0
+        self._done = False
+        if cursor.description is None:
+            self._finish(cursor.rowcount)
+
+    def _finish(self, rows):
+        if not self._done:
+            self._done = True
+            self._instrumentation.record(self._sql, self._elapsed, rows)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._elapsed += time.perf_counter() - start
+        self._finish(self._rows + (row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size if size is not None else self._cursor.arraysize)
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        if len(rows) == 0 or len(rows) < (size if size is not None else self._cursor.arraysize):
+            self._finish(self._rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._finish(self._rows + len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
 
 class Database(object):
 
+    # storage settings applied by open(profile=...) and set_profile(); cache_size < 0 is in KiB
+    PROFILES = {
+        # safe against power loss, moderate page cache
+        'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'cache_size': -8192, 'mmap_size': 0,
+                    'temp_store': 'DEFAULT'},
+        # large page cache and memory mapped reads, commits are durable up to the last checkpoint
+        'read_heavy': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536,
+                       'mmap_size': 268435456, 'temp_store': 'MEMORY'},
+        # fastest writes, a crash during the load can corrupt the file
+        'bulk_load': {'journal_mode': 'MEMORY', 'synchronous': 'OFF', 'cache_size': -262144, 'mmap_size': 0,
+                      'temp_store': 'MEMORY'},
+    }
+    # per connection settings, pooled readers get them as well
+    READER_PRAGMAS = ('cache_size', 'mmap_size', 'temp_store')
+
     def __init__(self):
         self.__database_path = None
         self.__db = None
         self.__opened = False
+        self.__transaction_depth = 0
+        self.__transaction_thread = None
+        self.__write_lock = threading.RLock()
+        self.__pool = None
+        self.__pool_size = 0
+        self.__pool_lock = threading.Lock()
+        self.__pool_waiters = collections.deque()
+        self.__pool_stats = None
+        self.__local = threading.local()
+        self.__cache = None
+        self.__cached_statements = 0
+        self.__check_plans = False
+        self.__checked_plans = set()
+        self.__plans_lock = threading.Lock()
+        self.__instrumentation = None
+        self.__profile = None
+        self.__profile_settings = dict()
+        self.__profile_version = 0
+        self.__skipped_pragmas = dict()
+        self.__reader_versions = dict()
+        self.__maintenance = None
+        self.__maintenance_stop = threading.Event()
+        self.__maintenance_stats = None
         return
 
-    def open(self, database_path=None, override=False):
+    def instrument(self, callback=None, slow_query_ms=None, logger=None):
+        self.__instrumentation = QueryInstrumentation(callback, slow_query_ms, logger)
+        return self.__instrumentation
+
+    def disable_instrumentation(self):
+        self.__instrumentation = None
+
+    def instrumentation(self):
+        return self.__instrumentation
+
+    def set_query_plan_check(self, enabled=True):
+        # debug mode: EXPLAIN QUERY PLAN every new filtered statement and warn on full table scans
+        with self.__plans_lock:
+            self.__check_plans = enabled
+            self.__checked_plans = set()
+
+    def __check_plan(self, conn, sql, params):
+        # pooled readers check plans from several threads, each statement is explained once
+        with self.__plans_lock:
+            if sql in self.__checked_plans:
+                return
+            self.__checked_plans.add(sql)
+        if ' WHERE ' not in sql.upper():
+            return
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall():
+            detail = row[-1]
+            if detail.startswith('SCAN ') and not detail.startswith('SCAN CONSTANT'):
+                warnings.warn('Query plan "' + detail + '" for: ' + sql, QueryPlanWarning, stacklevel=4)
+
+    def execute(self, conn, sql, params=()):
+        if self.__check_plans:
+            self.__check_plan(conn, sql, params)
+        if self.__instrumentation is None:
+            return conn.execute(sql, params)
+        start = time.perf_counter()
+        c = conn.execute(sql, params)
+        return _InstrumentedCursor(self.__instrumentation, c, sql, time.perf_counter() - start)
+
+    def executemany(self, conn, sql, seq_of_params):
+        if self.__instrumentation is None:
+            return conn.executemany(sql, seq_of_params)
+        start = time.perf_counter()
+        c = conn.executemany(sql, seq_of_params)
+        self.__instrumentation.record(sql, time.perf_counter() - start, c.rowcount)
+        return c
+
+    def __commit(self):
+        if self.__instrumentation is not None and self.__db.in_transaction:
+            self.__instrumentation.commits += 1
+        self.__db.commit()
+
+    def statement_cache_size(self):
+        return self.__cached_statements
+
+    def enable_cache(self, max_size=1024):
+        self.__cache = ObjectCache(max_size)
+
+    def disable_cache(self):
+        self.__cache = None
+
+    def cache(self):
+        return self.__cache
+
+    def open(self, database_path=None, override=False, cache_size=0, cached_statements=128, pool_size=0,
+             profile=None):
         assert isinstance(database_path, str)
         try:
             if override and os.path.isfile(database_path):
                 os.remove(database_path)
 
-            self.__db = sqlite3.connect(database_path, check_same_thread=False)
+            self.__db = sqlite3.connect(database_path, check_same_thread=False, cached_statements=cached_statements)
+            self.__cached_statements = cached_statements
             self.__opened = True
-            self.__database_path = ''
+            self.__database_path = database_path
+            if cache_size > 0:
+                self.enable_cache(cache_size)
+            if pool_size > 0:
+                if database_path == ':memory:' or database_path == '':
+                    print('Database pool requires a database file, using a single connection')
+                else:
+                    # WAL lets the pooled readers run while the writer connection commits
+                    self.__db.execute('PRAGMA journal_mode=WAL;')
+                    self.__pool = []
+                    self.__pool_size = pool_size
+                    self.__pool_stats = {'size': pool_size, 'created': 0, 'checkouts': 0, 'waits': 0,
+                                         'wait_time': 0.0}
+            if profile is not None and not self.set_profile(profile):
+                raise EdgeModelException('Profile ' + str(profile) + ' could not be applied', 1)
 
             print('Database opened: ' + database_path)
             return True
@@ -29,11 +376,27 @@ class Database(object):
             print('Database Error during opening: ', e)
         return False
 
+    def close(self):
+        self.stop_maintenance()
+        if self.__pool is not None:
+            with self.__pool_lock:
+                for conn in self.__pool:
+                    conn.close()
+                self.__pool = None
+        self.__reader_versions.clear()
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+        self.__opened = False
+
     def is_opened(self):
         if self.__db is not None:
             assert isinstance(self.__db, sqlite3.Connection)
         return self.__opened
 
+    def is_pooled(self):
+        return self.__pool is not None
+
     def get_database_path(self):
         return self.__database_path
 
@@ -46,12 +409,25 @@ class Database(object):
     def create_tables(self, tables):
         assert isinstance(self.__db, sqlite3.Connection)
         try:
-            for table in tables:
-                sql_create = getattr(table(), "_SQL_CREATE")
-                # print 'creating table: ', sql_create
-                c = self.__db.cursor()
-                c.execute(sql_create)
-                setattr(table, '_db', self.__db)
+            with self.writer() as conn:
+                for table in tables:
+                    sql_create = getattr(table(), "_SQL_CREATE")
+                    # print 'creating table: ', sql_create
+                    conn.execute(sql_create)
+                    for sql_index in getattr(table, '_SQL_CREATE_INDEXES'):
+                        conn.execute(sql_index)
+                    fts = getattr(table, '_FULLTEXT_TABLE')
+                    if fts is not None:
+                        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                                              (fts,)).fetchone()
+                        for sql_fulltext in getattr(table, '_SQL_CREATE_FULLTEXT'):
+                            conn.execute(sql_fulltext)
+                        if exists is None:
+                            # rows already in the table are indexed once
+                            conn.execute('INSERT INTO ' + fts + ' (' + fts + ") VALUES ('rebuild');")
+                            self.commit()
+                    setattr(table, '_db', self.__db)
+                    setattr(table, '_database', self)
             return True
         except Exception as e:
             print('Table ', table.__name__, ' Error: ', e)
@@ -60,6 +436,449 @@ class Database(object):
     def cursor(self):
         return self.__db.cursor()
 
+    def __checkout(self):
+        with self.__pool_lock:
+            self.__pool_stats['checkouts'] += 1
+            if len(self.__pool) > 0:
+                return self.__pool.pop()
+            if self.__pool_stats['created'] < self.__pool_size:
+                self.__pool_stats['created'] += 1
+                waiter = None
+            else:
+                # connections are handed to waiters in arrival order, see __checkin
+                self.__pool_stats['waits'] += 1
+                waiter = [threading.Event(), None]
+                self.__pool_waiters.append(waiter)
+        if waiter is None:
+            return self.__new_reader()
+        start = time.perf_counter()
+        waiter[0].wait()
+        with self.__pool_lock:
+            self.__pool_stats['wait_time'] += time.perf_counter() - start
+        return waiter[1]
+
+    def __new_reader(self):
+        conn = sqlite3.connect(self.__database_path, check_same_thread=False,
+                               cached_statements=self.__cached_statements)
+        conn.execute('PRAGMA query_only=1;')
+        self.__apply_reader_profile(conn)
+        return conn
+
+    def __checkin(self, conn):
+        with self.__pool_lock:
+            if self.__pool is None:
+                conn.close()
+            elif len(self.__pool_waiters) > 0:
+                waiter = self.__pool_waiters.popleft()
+                waiter[1] = conn
+                waiter[0].set()
+            else:
+                self.__pool.append(conn)
+
+    @contextlib.contextmanager
+    def reader(self):
+        # a thread inside transaction() reads through the writer to see its own changes
+        if self.__pool is None or self.in_transaction():
+            yield self.__db
+            return
+        # re-entrant per thread: reads made while this thread already holds a reader (lazy foreign keys,
+        # prefetch or deferred columns inside an iteration) reuse it instead of waiting on the pool
+        local = self.__local
+        if getattr(local, 'depth', 0) > 0:
+            local.depth += 1
+            try:
+                yield local.reader
+            finally:
+                self.__release_local()
+            return
+        conn = self.__checkout()
+        if self.__reader_versions.get(conn) != self.__profile_version:
+            self.__apply_reader_profile(conn)
+        local.reader = conn
+        local.depth = 1
+        try:
+            yield conn
+        finally:
+            self.__release_local()
+
+    def __release_local(self):
+        # the last user of the thread's reader returns it, whichever generator that is
+        local = self.__local
+        local.depth -= 1
+        if local.depth == 0:
+            conn = local.reader
+            local.reader = None
+            self.__checkin(conn)
+
+    @contextlib.contextmanager
+    def stream_reader(self):
+        # a reader of its own, outside the bounded pool, for cursors kept open between calls from
+        # different threads (AsyncDatabase iterators) so they never wait on each other's pooled connections
+        if self.__pool is None or self.in_transaction():
+            yield self.__db
+            return
+        conn = self.__new_reader()
+        try:
+            yield conn
+        finally:
+            self.__reader_versions.pop(conn, None)
+            conn.close()
+
+    @contextlib.contextmanager
+    def writer(self):
+        with self.__write_lock:
+            yield self.__db
+
+    def set_profile(self, profile):
+        # profile is a name of PROFILES or a dict of the same pragmas, it can be switched while open
+        if isinstance(profile, str):
+            if profile not in self.PROFILES:
+                raise EdgeModelException('Unknown profile ' + profile, 1)
+            settings = self.PROFILES[profile]
+        else:
+            settings = dict(profile)
+        if self.in_transaction():
+            raise EdgeModelException('set_profile can not run inside a transaction', 1)
+        try:
+            with self.writer() as conn:
+                journal_mode = settings.get('journal_mode')
+                skipped = dict()
+                # the pooled readers depend on WAL, so it stays on for pooled databases
+                if journal_mode is not None and self.__pool is not None and journal_mode.upper() != 'WAL':
+                    skipped['journal_mode'] = journal_mode
+                    print('Database set_profile: journal_mode=' + journal_mode + ' skipped, pooled databases stay in WAL')
+                elif journal_mode is not None:
+                    conn.execute('PRAGMA journal_mode=' + journal_mode + ';')
+                for name in ('synchronous', 'cache_size', 'mmap_size', 'temp_store'):
+                    if name in settings:
+                        conn.execute('PRAGMA ' + name + '=' + str(settings[name]) + ';')
+                self.__profile = profile if isinstance(profile, str) else 'custom'
+                self.__profile_settings = settings
+                self.__skipped_pragmas = skipped
+                self.__profile_version += 1
+            return True
+        except Exception as e:
+            print('Database set_profile Error: ', e)
+        return False
+
+    def profile(self):
+        return self.__profile
+
+    def skipped_pragmas(self):
+        # pragmas of the last profile that were not applied, with the requested values
+        return dict(self.__skipped_pragmas)
+
+    def __apply_reader_profile(self, conn):
+        for name in self.READER_PRAGMAS:
+            if name in self.__profile_settings:
+                conn.execute('PRAGMA ' + name + '=' + str(self.__profile_settings[name]) + ';')
+        self.__reader_versions[conn] = self.__profile_version
+
+    def pragmas(self):
+        # the settings in effect on the writer connection
+        names = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'auto_vacuum',
+                 'page_count', 'freelist_count')
+        settings = dict()
+        with self.writer() as conn:
+            for name in names:
+                row = conn.execute('PRAGMA ' + name + ';').fetchone()
+                settings[name] = row[0] if row is not None else None
+        return settings
+
+    def start_maintenance(self, interval=300, optimize=True, analyze=False, checkpoint='PASSIVE',
+                          incremental_vacuum=True):
+        # background thread running run_maintenance() every interval seconds until stop_maintenance()
+        assert interval > 0
+        if self.__maintenance is not None:
+            raise EdgeModelException('Maintenance is already running', 1)
+        self.__maintenance_stop.clear()
+        options = (optimize, analyze, checkpoint, incremental_vacuum)
+
+        def loop():
+            while not self.__maintenance_stop.wait(interval):
+                self.run_maintenance(*options)
+
+        self.__maintenance = threading.Thread(target=loop, name='EdgeModel-maintenance', daemon=True)
+        self.__maintenance.start()
+
+    def stop_maintenance(self):
+        if self.__maintenance is not None:
+            self.__maintenance_stop.set()
+            self.__maintenance.join()
+            self.__maintenance = None
+
+    def run_maintenance(self, optimize=True, analyze=False, checkpoint='PASSIVE', incremental_vacuum=True):
+        # PRAGMA optimize (or a full ANALYZE), a WAL checkpoint and an incremental vacuum, under the write lock
+        if self.in_transaction():
+            raise EdgeModelException('run_maintenance can not run inside a transaction', 1)
+        if self.__maintenance_stats is None:
+            self.__maintenance_stats = {'runs': 0, 'errors': 0, 'last_error': None, 'last_run': None,
+                                        'last_duration': 0.0, 'total_time': 0.0, 'optimize': 0, 'analyze': 0,
+                                        'checkpoints': 0, 'wal_pages': 0, 'checkpointed_pages': 0,
+                                        'vacuumed_pages': 0}
+        stats = self.__maintenance_stats
+        start = time.perf_counter()
+        try:
+            with self.writer() as conn:
+                if analyze:
+                    conn.execute('ANALYZE;')
+                    stats['analyze'] += 1
+                elif optimize:
+                    conn.execute('PRAGMA optimize;')
+                    stats['optimize'] += 1
+                if checkpoint and conn.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal':
+                    busy, log, checkpointed = conn.execute('PRAGMA wal_checkpoint(' + checkpoint + ');').fetchone()
+                    stats['checkpoints'] += 1
+                    stats['wal_pages'] = log
+                    stats['checkpointed_pages'] += max(checkpointed, 0)
+                # only databases created with PRAGMA auto_vacuum=INCREMENTAL keep the free pages to release
+                if incremental_vacuum and conn.execute('PRAGMA auto_vacuum;').fetchone()[0] == 2:
+                    free = conn.execute('PRAGMA freelist_count;').fetchone()[0]
+                    # executescript steps the pragma until every free page is released
+                    conn.executescript('PRAGMA incremental_vacuum;')
+                    stats['vacuumed_pages'] += free - conn.execute('PRAGMA freelist_count;').fetchone()[0]
+            return True
+        except Exception as e:
+            stats['errors'] += 1
+            stats['last_error'] = str(e)
+            print('Database run_maintenance Error: ', e)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats['runs'] += 1
+            stats['last_run'] = time.time()
+            stats['last_duration'] = elapsed
+            stats['total_time'] += elapsed
+        return False
+
+    def maintenance_stats(self):
+        if self.__maintenance_stats is None:
+            return None
+        stats = dict(self.__maintenance_stats)
+        stats['running'] = self.__maintenance is not None
+        return stats
+
+    def pool_stats(self):
+        if self.__pool_stats is None:
+            return None
+        with self.__pool_lock:
+            stats = dict(self.__pool_stats)
+            stats['idle'] = len(self.__pool)
+        return stats
+
+    def in_transaction(self):
+        return self.__transaction_depth > 0 and self.__transaction_thread == threading.get_ident()
+
+    def commit(self):
+        # inside transaction() the outermost block commits once
+        if not self.in_transaction():
+            self.__commit()
+
+    def rollback(self):
+        if not self.in_transaction():
+            self.__db.rollback()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        assert isinstance(self.__db, sqlite3.Connection)
+        with self.__write_lock:
+            depth = self.__transaction_depth
+            if depth == 0:
+                if self.__db.in_transaction:
+                    self.__db.commit()
+                self.__db.execute('BEGIN')
+                self.__transaction_thread = threading.get_ident()
+            else:
+                self.__db.execute('SAVEPOINT edge_sp_' + str(depth))
+            self.__transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.__transaction_depth = depth
+                # rows cached inside the block may have been rolled back
+                if self.__cache is not None:
+                    self.__cache.clear()
+                if depth == 0:
+                    self.__transaction_thread = None
+                    self.__db.rollback()
+                else:
+                    self.__db.execute('ROLLBACK TO edge_sp_' + str(depth))
+                    self.__db.execute('RELEASE edge_sp_' + str(depth))
+                raise
+            self.__transaction_depth = depth
+            if depth == 0:
+                self.__transaction_thread = None
+                self.__commit()
+            else:
+                self.__db.execute('RELEASE edge_sp_' + str(depth))
+
+    def bulk_insert(self, model, rows, chunk_size=1000):
+        try:
+            return self.__insert_rows(model, rows, chunk_size)
+        except Exception as e:
+            print('Table ', model.__name__, ' bulk_insert Error: ', e)
+        return None
+
+    def __insert_rows(self, model, rows, chunk_size):
+        # one transaction per chunk, raises on the first error
+        assert isinstance(self.__db, sqlite3.Connection)
+        assert chunk_size > 0
+        sample = model()
+        sql_insert = getattr(sample, '_SQL_INSERT')
+        columns = getattr(sample, '__KEY_NAMES') + getattr(sample, '__FIELD_NAMES')
+        defaults = dict((f.fieldname(), f.property(PT.DefaultValue)) for f in getattr(model, '__FIELDS'))
+
+        count = 0
+        chunk = []
+        for row in rows:
+            params = dict(defaults)
+            if isinstance(row, dict):
+                params.update(row)
+            else:
+                params.update(zip(columns, row))
+            chunk.append(params)
+            if len(chunk) >= chunk_size:
+                if self.__cache is not None:
+                    self.__cache.invalidate(model)
+                with self.transaction():
+                    self.executemany(self.__db, sql_insert, chunk)
+                count += len(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            if self.__cache is not None:
+                self.__cache.invalidate(model)
+            with self.transaction():
+                self.executemany(self.__db, sql_insert, chunk)
+            count += len(chunk)
+        return count
+
+    def import_rows(self, model, source, format='csv', chunk_size=1000):
+        # streams a CSV file (header row of field names) or JSON Lines in chunks of executemany; the whole
+        # import is one transaction, a bad line raises EdgeModelException with its line number and nothing is kept
+        if format not in ('csv', 'jsonl'):
+            raise EdgeModelException('Unknown import format ' + str(format), 1)
+        model._setup()
+        f = _open_file(source, 'r')
+        line = [0]
+        try:
+            if format == 'csv':
+                rows = self.__csv_rows(model, f, line)
+            else:
+                rows = self.__jsonl_rows(model, f, line)
+            with self.transaction():
+                return self.__insert_rows(model, rows, chunk_size)
+        except EdgeModelException:
+            raise
+        except Exception as e:
+            # insert errors surface when a chunk is written, the chunk ends at the last line read
+            raise EdgeModelException(model.__name__ + ' import failed in the rows up to line ' + str(line[0]) +
+                                     ': ' + str(e), 1) from e
+        finally:
+            if f is not source:
+                f.close()
+
+    def __csv_rows(self, model, f, line):
+        reader = csv.reader(f)
+        try:
+            header = next(reader, None)
+            if header is None:
+                return
+            fields = [model._field(name.strip()) for name in header]
+        except Exception as e:
+            raise EdgeModelException(model.__name__ + ' import failed at line 1: ' + str(e), 1) from e
+        names = [field.fieldname() for field in fields]
+        converters = [_text_converter(field) for field in fields]
+        for row in reader:
+            line[0] = reader.line_num
+            if len(row) == 0:
+                continue
+            try:
+                values = dict((name, convert(value)) for name, convert, value in zip(names, converters, row))
+            except (ValueError, TypeError) as e:
+                raise EdgeModelException(model.__name__ + ' import failed at line ' + str(line[0]) + ': ' + str(e),
+                                         1) from e
+            yield values
+
+    def __jsonl_rows(self, model, f, line):
+        columns = dict()
+        for number, text in enumerate(f, 1):
+            line[0] = number
+            text = text.strip()
+            if len(text) == 0:
+                continue
+            try:
+                row = dict()
+                for key, value in json.loads(text).items():
+                    if key not in columns:
+                        columns[key] = model._field(key).fieldname()
+                    row[columns[key]] = value
+            except Exception as e:
+                raise EdgeModelException(model.__name__ + ' import failed at line ' + str(number) + ': ' + str(e),
+                                         1) from e
+            yield row
+
+
+class AsyncDatabase(Database):
+
+    def __init__(self, workers=4):
+        Database.__init__(self)
+        assert workers > 0
+        self.__workers = workers
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.__pending = []
+        self.__flush_scheduled = False
+
+    def open(self, database_path=None, override=False, **kwargs):
+        # one pooled reader per worker thread, writes share the writer connection
+        kwargs.setdefault('pool_size', self.__workers)
+        return Database.open(self, database_path, override, **kwargs)
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+        Database.close(self)
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, functools.partial(fn, *args))
+
+    async def run_write(self, fn, *args):
+        # writes issued in the same loop iteration are committed together in one transaction
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__pending.append((functools.partial(fn, *args), future))
+        if not self.__flush_scheduled:
+            self.__flush_scheduled = True
+            loop.call_soon(self.__flush, loop)
+        return await future
+
+    def __flush(self, loop):
+        batch = self.__pending
+        self.__pending = []
+        self.__flush_scheduled = False
+        loop.run_in_executor(self.__executor, self.__run_batch, loop, batch)
+
+    def __run_batch(self, loop, batch):
+        results = []
+        try:
+            with self.transaction():
+                for fn, future in batch:
+                    # a failing write only rolls back its own savepoint
+                    try:
+                        with self.transaction():
+                            results.append((future, fn(), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            results = [(future, None, e) for fn, future in batch]
+        for future, result, error in results:
+            loop.call_soon_threadsafe(_resolve_future, future, result, error)
+
+
+# SQLITE_MAX_VARIABLE_NUMBER is 999 on sqlite < 3.32, keep IN (...) lists below it
+SQL_MAX_VARIABLES = 900
+
+# INSERT ... ON CONFLICT DO UPDATE needs sqlite 3.24, RETURNING needs 3.35
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 35, 0)
+
 
 class EdgeModelException(Exception):
 
@@ -68,6 +887,10 @@ class EdgeModelException(Exception):
         self.idx = idx
 
 
+class QueryPlanWarning(UserWarning):
+    pass
+
+
 
 
 class FieldType(object):
@@ -92,6 +915,8 @@ class PT(object):  # property index
     ForeignModel = 9
     ForeignTable = 10
     ForeignKey = 11
+    Indexed = 12
+    FullText = 13
     Properties = 'Properties'
     Fields = 0
     Keys = 1
@@ -113,25 +938,74 @@ class AutoIncrement(object):
     pass
 
 
+class Indexed(object):
+    pass
+
+
+class FullText(object):
+    pass
+
+
+class Index(object):
+
+    def __init__(self, *fields, **kwargs):
+        if len(fields) == 0:
+            raise EdgeModelException('Index must have at least one field', 1)
+        self.fields = fields
+        self.name = kwargs.get('Name')
+        self.unique = kwargs.get('Unique', False)
+        self.where = kwargs.get('Where')
+
+
 class Field(object):
 
     __type = FieldType.TEXT
     _properties = None
     _object = None
+    _memo = None
+    _owner = None
+    _position = 0
 
     # TODO *kwargs NotNull AutoIncremnt Unique PrimaryKey EdgeModel
     def __init__(self, *vargs, **kwargs):
         self.__init_args(vargs, kwargs)
-        self.__value = [self._properties[PT.DefaultValue]]
+        # unbound fields keep their value in a row of their own
+        self._values = [self._properties[PT.DefaultValue]]
+        self._index = 0
+        self._changes = set()
+
+    def __get__(self, obj, owner=None):
+        # model classes hold the field definitions; an instance gets a field bound to its row on first access
+        if obj is None:
+            return self
+        f = self._bind(obj)
+        obj.__dict__[self._attrname] = f
+        return f
+
+    def _bind(self, obj):
+        # shallow copy sharing the immutable _properties of the model definition
+        f = self.__class__.__new__(self.__class__)
+        f._properties = self._properties
+        f._attrname = self._attrname
+        f._values = obj._row
+        f._index = self._position
+        f._changes = obj._changes
+        f._owner = obj
+        return f
 
     def set_value(self, val):
-        self.__value[0] = val
+        self._values[self._index] = val
+        self._changes.add(self._index)
 
     def get_value(self):
-        return self.__value[0]
+        value = self._values[self._index]
+        if value is _DEFERRED:
+            self._owner._load_deferred()
+            value = self._values[self._index]
+        return value
 
     def get_value_as_ref(self):
-        return self.__value
+        return _ValueRef(self._values, self._index)
 
     def __init_args(self, vargs, kwargs):
         self._properties = dict()
@@ -164,6 +1038,21 @@ class Field(object):
         else:
             self._properties[PT.AutoIncrement] = False
 
+        if any(v is Indexed for v in vargs) is True:
+            self._properties[PT.Indexed] = True
+        elif 'Indexed' in kwargs:
+            self._properties[PT.Indexed] = kwargs['Indexed']
+        else:
+            # foreign keys are indexed unless Indexed=False is given
+            self._properties[PT.Indexed] = 'ForeignModel' in kwargs
+
+        if any(v is FullText for v in vargs) is True:
+            self._properties[PT.FullText] = True
+        elif 'FullText' in kwargs:
+            self._properties[PT.FullText] = kwargs['FullText']
+        else:
+            self._properties[PT.FullText] = False
+
         if 'FieldName' in kwargs:
             self._properties[PT.FieldName] = kwargs['FieldName']
         else:
@@ -191,6 +1080,9 @@ class Field(object):
 
         if 'ForeignModel' in kwargs:
             self._properties[PT.ForeignModel] = kwargs['ForeignModel']
+            if isinstance(self._properties[PT.ForeignModel], type) and \
+                    issubclass(self._properties[PT.ForeignModel], EdgeModel):
+                self._properties[PT.ForeignModel]._setup()
 
             if len(getattr(self._properties[PT.ForeignModel], '__KEY_NAMES')) == 0:
                 raise EdgeModelException('Model does not has primary key', 1)
@@ -215,9 +1107,44 @@ class Field(object):
         return self._properties[PT.ForeignModel] is not None
 
     def get_object(self):
+        # foreign models are loaded on first access; rows of the same result set share one memo
+        if self._object is None and self._properties[PT.ForeignModel] is not None:
+            value = self.get_value()
+            if value is None:
+                return None
+            memo = self._memo
+            if memo is None:
+                memos = self._owner._memos if self._owner is not None else None
+                memo = memos.setdefault(self._attrname, dict()) if memos is not None else dict()
+            if value not in memo:
+                memo[value] = self._properties[PT.ForeignModel]().get_by_id(value)
+            self._object = memo[value]
         return self._object
 
 
+class _ValueRef(object):
+    # one item view of a field's slot in its model's row
+
+    __slots__ = ('_values', '_index')
+
+    def __init__(self, values, index):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, i):
+        if i != 0:
+            raise IndexError(i)
+        return self._values[self._index]
+
+    def __setitem__(self, i, value):
+        if i != 0:
+            raise IndexError(i)
+        self._values[self._index] = value
+
+    def __len__(self):
+        return 1
+
+
 class IntegerField(Field):
     __type = FieldType.INTEGER
 
@@ -236,6 +1163,7 @@ class IntegerField(Field):
         else:
             assert isinstance(val, int)
             Field.set_value(self, val)
+            self._object = None
 
 
 class TextField(Field):
@@ -294,36 +1222,59 @@ class EdgeModel(object):
     table_name = None
     _SQL_CREATE, _SQL_INSERT, _SQL_UPDATE, _SQL_DELETE, _SQL_IS_PERSISTED = None, None, None, None, None
     _SQL_SELECT_SINGLE, _SQL_SELECT, _SQL_SELECT_ROWID = None, None, None
+    _SQL_UPSERT, _SQL_UPSERT_MANY = None, None
+    _SQL_CREATE_INDEXES = None
+    _SQL_CREATE_FULLTEXT, _SQL_SEARCH, _FULLTEXT_TABLE = None, None, None
     _db = None
-    __keys = None
-    __fields = None
-    __all_field_names = None
+    _database = None
+    _memos = None
 
     # Global vars
     _join = None
     _where = None
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # fields and SQL are built once, when the model class is defined
+        if cls.__define_model__ is not EdgeModel.__define_model__:
+            try:
+                cls._setup()
+            except NameError:
+                # __define_model__ refers to a model defined further down, set up on first use
+                pass
+
+    @classmethod
+    def _setup(cls):
+        if '__STATIC_VARS' not in cls.__dict__:
+            cls.__new__(cls).__set_static_vars()
+
     def __init__(self, hash_data=None):
-        self.__set_static_vars()
-        self.__set_data_vars()
+        cls = self.__class__
+        if '__STATIC_VARS' not in cls.__dict__:
+            cls._setup()
+        # values in _SQL_SELECT column order, fields are bound to this row on first access
+        self._row = list(getattr(cls, '__DEFAULTS'))
+        self._changes = set()
+        self.__persisted = False
 
     '''Static -------------------------------------------------------------------------------------'''
     # fields = [getattr(self, name) for name in props if isinstance(getattr(self, name), Field)] #keys = [field for field in fields if field._properties[PT.PrimaryKey] is True]
 
     def __set_static_vars(self):
-
-        if hasattr(self.__class__, '__STATIC_VARS'):
-            return
-
+        # runs once per model class on a bare instance, see _setup
         self.__define_model__()
 
         props = dir(self)
         fields, keys = [], []
         field_names = []
         key_names = []
+        indexes = []
         for name in props:
-            f = getattr(self, name)
-            if isinstance(f, Field):
+            f = self.__dict__[name] if name in self.__dict__ else getattr(self.__class__, name, None)
+            if isinstance(f, Index):
+                setattr(f, '_attrname', name)
+                indexes.append(f)
+            elif isinstance(f, Field):
                 setattr(f, '_attrname', name)
                 fields.append(f)
                 if f.property(PT.PrimaryKey) is True:
@@ -334,9 +1285,26 @@ class EdgeModel(object):
 
         setattr(self.__class__, '__FIELDS', fields)
         setattr(self.__class__, '__KEYS', keys)
+        setattr(self.__class__, '__INDEXES', indexes)
         setattr(self.__class__, '__TABLE', self.table_name)
         setattr(self.__class__, '__FIELD_NAMES', field_names)
         setattr(self.__class__, '__KEY_NAMES', key_names)
+        setattr(self.__class__, '__ALL_FIELD_NAMES', key_names + field_names)
+        select_fields = keys + [f for f in fields if f.property(PT.PrimaryKey) is not True]
+        for i, f in enumerate(select_fields):
+            f._position = i
+            setattr(self.__class__, f._attrname, f)
+        self.__class__.table_name = self.table_name
+        setattr(self.__class__, '__SELECT_FIELDS', select_fields)
+        setattr(self.__class__, '__POSITIONS', dict((f.fieldname(), i) for i, f in enumerate(select_fields)))
+        setattr(self.__class__, '__DEFAULTS', [f.property(PT.DefaultValue) for f in select_fields])
+        setattr(self.__class__, '__INTEGER_POSITIONS', [i for i, f in enumerate(select_fields)
+                                                         if isinstance(f, IntegerField)])
+        setattr(self.__class__, '__FOREIGN_FIELDS', [f for f in fields if f.is_foreign_key()])
+        setattr(self.__class__, '__RECORD', collections.namedtuple(self.__class__.__name__ + 'Record',
+                                                                   key_names + field_names, rename=True))
+        setattr(self.__class__, '__PROJECTIONS', dict())
+        setattr(self.__class__, '__UPDATES', dict())
         self.__create_sqls()
         setattr(self.__class__, '__STATIC_VARS', True)
 
@@ -349,6 +1317,9 @@ class EdgeModel(object):
         self.__sql_select()
         self.__sql_select_rowid()
         self.__sql_select_single()
+        self.__sql_upsert()
+        self.__sql_create_indexes()
+        self.__sql_fulltext()
 
     def __sql_create(self):
         fields = getattr(self.__class__, '__FIELDS')
@@ -428,51 +1399,268 @@ class EdgeModel(object):
         s += ' WHERE rowid = :rowid;'
         setattr(self.__class__, '_SQL_SELECT_ROWID', s)
 
+    def __sql_upsert(self):
+        field_names = getattr(self, '__FIELD_NAMES')
+        key_names = getattr(self, '__KEY_NAMES')
+        if not SQLITE_HAS_UPSERT or len(key_names) == 0 or len(field_names) == 0:
+            setattr(self.__class__, '_SQL_UPSERT', None)
+            setattr(self.__class__, '_SQL_UPSERT_MANY', None)
+            return
+        s = getattr(self, '_SQL_INSERT').rstrip(';') + ' ON CONFLICT(' + ",".join(key_names) + ') DO UPDATE SET ' + \
+            ", ".join(c + ' = excluded.' + c for c in field_names)
+        setattr(self.__class__, '_SQL_UPSERT_MANY', s + ';')
+        s += ' RETURNING ' + ", ".join(key_names + field_names) + ';'
+        setattr(self.__class__, '_SQL_UPSERT', s)
+
+    def __sql_create_indexes(self):
+        sqls = []
+        for f in getattr(self.__class__, '__FIELDS'):
+            # primary keys and UNIQUE columns already have an index
+            if f.property(PT.Indexed) is True and f.property(PT.PrimaryKey) is not True and \
+                    f.property(PT.Unique) is not True:
+                sqls.append('CREATE INDEX IF NOT EXISTS idx_' + self.table_name + '_' + f.fieldname() + ' ON ' +
+                            self.table_name + ' (' + f.fieldname() + ');')
+        for index in getattr(self.__class__, '__INDEXES'):
+            columns = []
+            for name in index.fields:
+                column = self.__class__._field(name.lstrip('-')).fieldname()
+                columns.append(column + ' DESC' if name.startswith('-') else column)
+            name = index.name if index.name is not None else 'idx_' + self.table_name + '_' + index._attrname
+            s = 'CREATE ' + ('UNIQUE ' if index.unique else '') + 'INDEX IF NOT EXISTS ' + name + ' ON ' + \
+                self.table_name + ' (' + ", ".join(columns) + ')'
+            if index.where is not None:
+                s += ' WHERE ' + index.where
+            sqls.append(s + ';')
+        setattr(self.__class__, '_SQL_CREATE_INDEXES', sqls)
+
+    def __sql_fulltext(self):
+        # FTS5 external content table over the FullText columns, kept in sync by triggers
+        fields = [f for f in getattr(self.__class__, '__FIELDS') if f.property(PT.FullText) is True]
+        if len(fields) == 0:
+            return
+        for f in fields:
+            if not isinstance(f, TextField):
+                raise EdgeModelException('FullText field ' + f.fieldname() + ' must be a TextField', 1)
+        keys = getattr(self.__class__, '__KEYS')
+        rowid = keys[0].fieldname() if len(keys) == 1 and isinstance(keys[0], IntegerField) else 'rowid'
+        table = self.table_name
+        fts = table + '_fts'
+        columns = [f.fieldname() for f in fields]
+        new = ", ".join('new.' + c for c in [rowid] + columns)
+        old = ", ".join('old.' + c for c in [rowid] + columns)
+        insert = 'INSERT INTO ' + fts + ' (rowid, ' + ", ".join(columns) + ') VALUES (' + new + ');'
+        delete = 'INSERT INTO ' + fts + ' (' + fts + ', rowid, ' + ", ".join(columns) + ") VALUES ('delete', " + old + ');'
+        setattr(self.__class__, '_FULLTEXT_TABLE', fts)
+        setattr(self.__class__, '_SQL_CREATE_FULLTEXT', [
+            'CREATE VIRTUAL TABLE IF NOT EXISTS ' + fts + ' USING fts5(' + ", ".join(columns) + ", content='" +
+            table + "', content_rowid='" + rowid + "');",
+            'CREATE TRIGGER IF NOT EXISTS ' + fts + '_ai AFTER INSERT ON ' + table + ' BEGIN ' + insert + ' END;',
+            'CREATE TRIGGER IF NOT EXISTS ' + fts + '_ad AFTER DELETE ON ' + table + ' BEGIN ' + delete + ' END;',
+            # only changes of the indexed columns (or the row id) touch the index
+            'CREATE TRIGGER IF NOT EXISTS ' + fts + '_au AFTER UPDATE OF ' + ", ".join(columns + [rowid]) + ' ON ' +
+            table + ' BEGIN ' + delete + ' ' + insert + ' END;'])
+        setattr(self.__class__, '_SQL_SEARCH', 'SELECT ' + ", ".join(table + '.' + c for c in getattr(
+            self.__class__, '__ALL_FIELD_NAMES')) + ' FROM ' + fts + ' JOIN ' + table + ' ON ' + table + '.' + rowid +
+            ' = ' + fts + '.rowid WHERE ' + fts + ' MATCH ? ORDER BY ' + fts + '.rank LIMIT ? OFFSET ?;')
+
     def __define_model__(self):
         raise EdgeModelException('Must be defined in model class', 1)
 
     # Object
 
-    def __set_data_vars(self):
-        fields = getattr(self.__class__, '__FIELDS')
-        self.__values = dict()
-        self.__fields = []
-        self.__keys = []
+    @classmethod
+    def _from_row(cls, row):
+        # builds an instance straight from a cursor tuple in _SQL_SELECT column order
+        obj = cls.__new__(cls)
+        obj._row = list(row)
+        obj._changes = set()
+        obj.__persisted = True
+        return obj
+
+    def __load_row(self, row):
+        # in place, bound fields share the row list
+        self._row[:] = row
+        self.__mark_clean()
+
+    def __mark_clean(self):
+        # the object now matches its row
+        self.__persisted = True
+        self._changes.clear()
+
+    def is_dirty(self):
+        return not self.__persisted or len(self._changes) > 0
+
+    @classmethod
+    def _projection(cls, only=None, defer=None):
+        # select-order column names for only()/defer(), primary keys are always loaded; None means all
+        if only is None and not defer:
+            return None
+        fields = getattr(cls, '__SELECT_FIELDS')
+        if only is not None:
+            wanted = set(cls._field(name).fieldname() for name in only)
+        else:
+            wanted = set(f.fieldname() for f in fields) - set(cls._field(name).fieldname() for name in defer)
+        return [f.fieldname() for f in fields if f.property(PT.PrimaryKey) is True or f.fieldname() in wanted]
+
+    @classmethod
+    def _sql_select(cls, columns=None):
+        if columns is None:
+            return cls._SQL_SELECT
+        return 'SELECT ' + ", ".join(columns) + ' FROM ' + getattr(cls, '__TABLE') + ' '
+
+    @classmethod
+    def __projection_rows(cls, rows, columns, records):
+        projections = getattr(cls, '__PROJECTIONS')
+        key = tuple(columns)
+        if key not in projections:
+            names = getattr(cls, '__ALL_FIELD_NAMES')
+            projections[key] = (collections.namedtuple(cls.__name__ + 'Record', columns, rename=True),
+                                [names.index(c) for c in columns], [_DEFERRED] * len(names))
+        record, positions, template = projections[key]
+        if records:
+            return list(map(record._make, rows))
+        full_rows = []
+        for row in rows:
+            full = list(template)
+            for i, value in zip(positions, row):
+                full[i] = value
+            full_rows.append(full)
+        return full_rows
+
+    def _load_deferred(self):
+        deferred = [i for i, value in enumerate(self._row) if value is _DEFERRED]
+        if len(deferred) == 0:
+            return
+        names = getattr(self.__class__, '__ALL_FIELD_NAMES')
+        sql = 'SELECT ' + ", ".join(names[i] for i in deferred) + ' FROM ' + getattr(self.__class__, '__TABLE') + \
+              ' WHERE ' + " and ".join(k + ' = :' + k for k in getattr(self.__class__, '__KEY_NAMES')) + ';'
+        with self._reader() as conn:
+            row = self.__execute_query(conn, sql, self.__key_positions()).fetchone()
+        if row is None:
+            row = [None] * len(deferred)
+        for i, value in zip(deferred, row):
+            self._row[i] = value
+
+    @classmethod
+    def _materialize(cls, rows, records=False, memos=None, columns=None):
+        if columns is not None:
+            if records:
+                return cls.__projection_rows(rows, columns, True)
+            rows = cls.__projection_rows(rows, columns, False)
+        elif records:
+            return list(map(getattr(cls, '__RECORD')._make, rows))
+        from_row = cls._from_row
+        objs = [from_row(row) for row in rows]
+        if len(getattr(cls, '__FOREIGN_FIELDS')) > 0:
+            # get_object() of the rows of one result set share a memo per foreign key
+            if memos is None:
+                memos = dict()
+            for obj in objs:
+                obj._memos = memos
+        return objs
+
+    @classmethod
+    def _iterate_cursor(cls, c, batch_size, records=False, prefetch=None, columns=None):
+        rows = c.fetchmany(batch_size)
+        while len(rows) > 0:
+            # foreign key memos are per batch so a long stream does not keep every related object alive
+            objs = cls._materialize(rows, records, None, columns)
+            if prefetch and not records:
+                cls._prefetch(objs, prefetch)
+            for obj in objs:
+                yield obj
+            rows = c.fetchmany(batch_size)
+
+    @classmethod
+    def _prefetch(cls, objs, names):
+        # loads the ForeignModel rows of each field with batched IN (...) queries
+        for name in names:
+            f = cls._field(name)
+            if not f.is_foreign_key():
+                raise EdgeModelException('Field ' + str(name) + ' is not a foreign key', 1)
+            foreign = f.property(PT.ForeignModel)
+            fields = [getattr(o, f._attrname) for o in objs]
+            values = list(set(field.get_value() for field in fields if field.get_value() is not None))
+            related = dict()
+            with foreign._reader() as conn:
+                for start in range(0, len(values), SQL_MAX_VARIABLES):
+                    chunk = values[start:start + SQL_MAX_VARIABLES]
+                    c = foreign._execute(conn, foreign._SQL_SELECT + ' WHERE ' + f.property(PT.ForeignKey) + ' IN (' +
+                                         ",".join('?' for _ in chunk) + ');', chunk)
+                    for obj in foreign._materialize(c.fetchall()):
+                        related[obj.get_keys()[0].get_value()] = obj
+            for field in fields:
+                field._object = related.get(field.get_value())
+
+    def __key_positions(self):
+        return range(len(getattr(self.__class__, '__KEYS')))
+
+    def __params(self, positions=None):
+        # named parameters of the row, all columns when positions is None
+        row = self._row
+        if positions is None:
+            positions = range(len(row))
+        if any(row[i] is _DEFERRED for i in positions):
+            self._load_deferred()
+        names = getattr(self.__class__, '__ALL_FIELD_NAMES')
+        return dict((names[i], row[i]) for i in positions)
+
+    def __execute_query(self, conn, query, positions=None):
+        return self._execute(conn, query, self.__params(positions))
+
+    @classmethod
+    def _execute(cls, conn, sql, params=()):
+        if cls._database is not None:
+            return cls._database.execute(conn, sql, params)
+        return conn.execute(sql, params)
+
+    @classmethod
+    def _executemany(cls, conn, sql, seq_of_params):
+        if cls._database is not None:
+            return cls._database.executemany(conn, sql, seq_of_params)
+        return conn.executemany(sql, seq_of_params)
+
+    @classmethod
+    def _reader(cls):
+        if cls._database is not None:
+            return cls._database.reader()
+        return _single_connection(cls._db)
+
+    @classmethod
+    def _writer(cls):
+        if cls._database is not None:
+            return cls._database.writer()
+        return _single_connection(cls._db)
+
+    def __commit(self):
+        if self._database is not None:
+            self._database.commit()
+        else:
+            self._db.commit()
 
-        for f in fields:
-            # TODO TRY ONLY COPY INSTEAD DEEPCOPY
-            newfield = copy.deepcopy(f)
-            del newfield._attrname
-            setattr(self, f._attrname, newfield)
-            self.__fields.append(newfield)
-            self.__values[newfield.fieldname()] = newfield.get_value_as_ref()
-            if newfield.property(PT.PrimaryKey) is True:
-                self.__keys.append(newfield)
-        self.__all_field_names = getattr(self, '__KEY_NAMES') + getattr(self, '__FIELD_NAMES')
-
-    def __execute_query(self, query, fields=None):
-        params = dict()
-        for f in fields:
-            params[f.fieldname()] = f.get_value()
+    def __cache(self):
+        if self._database is not None:
+            return self._database.cache()
+        return None
 
-        if self._db is not None:
-            c = self._db.cursor()
-            c.execute(query, params)
-            return c
+    def __key_values(self):
+        return tuple(self._row[:len(getattr(self.__class__, '__KEYS'))])
 
-        return None
+    def __cache_row(self, row):
+        cache = self.__cache()
+        if cache is not None:
+            cache.put(self.__class__, self.__key_values(), tuple(row))
+
+    def __uncache(self):
+        cache = self.__cache()
+        if cache is not None:
+            cache.invalidate(self.__class__, self.__key_values())
 
-    def __load_by_rowid(self, rowid):
-        try:
-            c = self._db.cursor()
-            c.execute(self.__class__._SQL_SELECT_ROWID, {'rowid': rowid})
-            row = c.fetchone()
-            i = 0
-            data = {}
-            for v in self.__all_field_names:
-                data[v] = row[i]
-                i += 1
-            self.load_from_array(data)
+    def __load_by_rowid(self, conn, rowid):
+        try:
+            row = self._execute(conn, self.__class__._SQL_SELECT_ROWID, {'rowid': rowid}).fetchone()
+            self.__load_row(row)
+            self.__cache_row(row)
             return True
         except Exception as e:
             pass
@@ -481,16 +1669,11 @@ class EdgeModel(object):
 
     def __load_by_keys(self):
         try:
-            r = self.__execute_query(self.__class__._SQL_SELECT_SINGLE, self.__keys)
-            self._db.commit()
-            row = r.fetchone()
-            if len(row):
-                i = 0
-                data = {}
-                for v in self.__all_field_names:
-                    data[v] = row[i]
-                    i += 1
-                self.load_from_array(data)
+            with self._reader() as conn:
+                row = self.__execute_query(conn, self.__class__._SQL_SELECT_SINGLE, self.__key_positions()).fetchone()
+            if row is not None:
+                self.__load_row(row)
+                self.__cache_row(row)
                 return True
         except Exception as e:
             print(self.__class__.__name__, '__load_by_keys -> Error -> ', e)
@@ -498,11 +1681,10 @@ class EdgeModel(object):
 
     def __is_persisted(self):
         try:
-            if self.__keys[0].get_value() is None:
+            if self._row[0] is None:
                 return False
-            r = self.__execute_query(self.__class__._SQL_IS_PERSISTED, self.__keys)
-            self._db.commit()
-            data = r.fetchone()
+            with self._reader() as conn:
+                data = self.__execute_query(conn, self.__class__._SQL_IS_PERSISTED, self.__key_positions()).fetchone()
 
             if data is not None:
                 if len(data) > 0:
@@ -511,12 +1693,41 @@ class EdgeModel(object):
             print(self.__class__.__name__, '__is_persisted -> Error -> ', e)
         return False
 
+    def __sql_update_columns(self, columns):
+        # one UPDATE per set of changed columns, built on first use
+        updates = getattr(self.__class__, '__UPDATES')
+        if columns not in updates:
+            updates[columns] = 'UPDATE ' + getattr(self.__class__, '__TABLE') + ' SET ' + \
+                ", ".join(c + ' = :' + c for c in columns) + ' WHERE ' + \
+                " and ".join(k + ' = :' + k for k in getattr(self.__class__, '__KEY_NAMES')) + ';'
+        return updates[columns]
+
+    def __update_dirty(self, dirty):
+        try:
+            self.__uncache()
+            names = getattr(self.__class__, '__ALL_FIELD_NAMES')
+            sql = self.__sql_update_columns(tuple(names[i] for i in dirty))
+            with self._writer() as conn:
+                r = self.__execute_query(conn, sql, dirty + list(self.__key_positions()))
+                self.__commit()
+            if r.rowcount > 0:
+                self._changes.difference_update(dirty)
+                if not any(value is _DEFERRED for value in self._row):
+                    self.__cache_row(self._row)
+                return True
+        except Exception as e:
+            print(self.__class__.__name__, '__update_dirty -> Error -> ', e)
+        return False
+
     def __update(self):
         try:
-            r = self.__execute_query(self.__class__._SQL_UPDATE, self.__fields)
-            self._db.commit()
+            self.__uncache()
+            with self._writer() as conn:
+                r = self.__execute_query(conn, self.__class__._SQL_UPDATE)
+                self.__commit()
             if r.rowcount > 0:
                 # TODO RELOAD
+                self.__mark_clean()
                 return True
         except Exception as e:
             print(self.__class__.__name__, '__update -> Error -> ', e)
@@ -524,143 +1735,411 @@ class EdgeModel(object):
 
     def __insert(self):
         try:
-            r = self.__execute_query(self.__class__._SQL_INSERT, self.__fields)
-            self._db.commit()
-            if r.lastrowid is not None and r.lastrowid > 0:
-                return self.__load_by_rowid(r.lastrowid)
+            with self._writer() as conn:
+                r = self.__execute_query(conn, self.__class__._SQL_INSERT)
+                self.__commit()
+                if r.lastrowid is not None and r.lastrowid > 0:
+                    return self.__load_by_rowid(conn, r.lastrowid)
         except Exception as e:
             print(self.__class__.__name__, '__insert -> Error -> ', e)
         return False
 
+    def __upsert(self):
+        try:
+            with self._writer() as conn:
+                row = self.__execute_query(conn, self.__class__._SQL_UPSERT).fetchone()
+                self.__commit()
+            if row is not None:
+                # sqlite (3.40 at least) returns the INTEGER columns of RETURNING as floats when the
+                # table has a REAL column
+                row = list(row)
+                for i in getattr(self.__class__, '__INTEGER_POSITIONS'):
+                    if isinstance(row[i], float) and row[i].is_integer():
+                        row[i] = int(row[i])
+                self.__load_row(row)
+                self.__cache_row(row)
+                return True
+        except Exception as e:
+            print(self.__class__.__name__, '__upsert -> Error -> ', e)
+        return False
+
     def __delete(self):
         try:
-            r = self.__execute_query(self.__class__._SQL_DELETE, self.__keys)
-            self._db.commit()
+            self.__uncache()
+            with self._writer() as conn:
+                r = self.__execute_query(conn, self.__class__._SQL_DELETE, self.__key_positions())
+                self.__commit()
             if r.rowcount > 0:
+                self.__persisted = False
                 return True
         except Exception as e:
             print(self.__class__.__name__, '__insert -> Error -> ', e)
         return False
 
     def get_keys(self):
-        return self.__keys
+        return [getattr(self, k._attrname) for k in getattr(self.__class__, '__KEYS')]
 
     def save(self):
+        keys = len(getattr(self.__class__, '__KEYS'))
+        if self.__persisted and not any(i < keys for i in self._changes):
+            # loaded objects only write the columns changed since, clean ones skip the round-trip
+            dirty = sorted(self._changes)
+            if len(dirty) == 0:
+                return True
+            if self.__update_dirty(dirty):
+                return True
+        if self.__class__._SQL_UPSERT is not None:
+            return self.__upsert()
         if self.__is_persisted():
             return self.__update()
         return self.__insert()
 
-    def delete(self):
-        if self.__is_persisted():
-            return self.__delete()
+    @classmethod
+    def save_many(cls, objs, chunk_size=1000):
+        assert chunk_size > 0
+        objs = [o for o in objs if o.is_dirty()]
+        if len(objs) == 0:
+            return True
+
+        try:
+            for start in range(0, len(objs), chunk_size):
+                if cls._database is not None:
+                    with cls._database.transaction():
+                        cls.__save_chunk(objs[start:start + chunk_size])
+                else:
+                    cls.__save_chunk(objs[start:start + chunk_size])
+                    cls._db.commit()
+            return True
+        except Exception as e:
+            if cls._database is None:
+                cls._db.rollback()
+            print(cls.__name__, 'save_many -> Error -> ', e)
         return False
 
+    @classmethod
+    def __save_chunk(cls, objs):
+        keys = getattr(cls, '__KEYS')
+        # save_many runs each chunk inside transaction(), which holds the writer connection
+        conn = cls._db
+        if cls._database is not None and cls._database.cache() is not None:
+            cache = cls._database.cache()
+            for o in objs:
+                cache.invalidate(cls, o.__key_values())
+
+        new_rows = [o for o in objs if o._row[0] is None]
+        with_key = [o for o in objs if o._row[0] is not None]
+        if len(with_key) > 0:
+            if cls._SQL_UPSERT_MANY is not None:
+                cls._executemany(conn, cls._SQL_UPSERT_MANY, [o.__params() for o in with_key])
+            else:
+                persisted = cls.__persisted_keys(conn, with_key)
+                updates, inserts = [], []
+                for o in with_key:
+                    if o.__key_values() in persisted:
+                        updates.append(o.__params())
+                    else:
+                        inserts.append(o.__params())
+                if len(updates) > 0:
+                    cls._executemany(conn, cls._SQL_UPDATE, updates)
+                if len(inserts) > 0:
+                    cls._executemany(conn, cls._SQL_INSERT, inserts)
+            for o in with_key:
+                o.__mark_clean()
+
+        if len(new_rows) > 0:
+            cls._executemany(conn, cls._SQL_INSERT, [o.__params() for o in new_rows])
+            # rows inserted with a NULL INTEGER PRIMARY KEY by one statement get consecutive rowids,
+            # so the keys can be back-filled from last_insert_rowid() without selecting them again
+            if len(keys) == 1 and isinstance(keys[0], IntegerField):
+                last = conn.execute('SELECT last_insert_rowid();').fetchone()[0]
+                first = last - len(new_rows) + 1
+                for i, o in enumerate(new_rows):
+                    o._row[0] = first + i
+                    o.__mark_clean()
+
+    @classmethod
+    def __persisted_keys(cls, conn, objs):
+        keys = getattr(cls, '__KEYS')
+        persisted = set()
+        if len(keys) == 1:
+            key_name = keys[0].fieldname()
+            for start in range(0, len(objs), SQL_MAX_VARIABLES):
+                values = [o._row[0] for o in objs[start:start + SQL_MAX_VARIABLES]]
+                c = cls._execute(conn, 'SELECT ' + key_name + ' FROM ' + getattr(cls, '__TABLE') + ' WHERE ' +
+                                 key_name + ' IN (' + ",".join('?' for _ in values) + ');', values)
+                persisted.update((r[0],) for r in c.fetchall())
+        else:
+            for o in objs:
+                if cls._execute(conn, cls._SQL_IS_PERSISTED, o.__params(o.__key_positions())).fetchone() is not None:
+                    persisted.add(o.__key_values())
+        return persisted
+
+    def delete(self):
+        # the DELETE row count tells whether the row existed, no SELECT first
+        if self._row[0] is None:
+            return False
+        return self.__delete()
+
     def load(self):
-        if self.__is_persisted():
-            return self.__load_by_keys()
-        return False
+        if self._row[0] is None:
+            return False
+        cache = self.__cache()
+        if cache is not None:
+            row = cache.get(self.__class__, self.__key_values())
+            if row is not None:
+                self.__load_row(row)
+                return True
+        return self.__load_by_keys()
 
     def load_from_array(self, data):
+        positions = getattr(self.__class__, '__POSITIONS')
         for key, value in data.items():
-            if key in self.__values:
-                self.__values[key][0] = value
+            if key in positions:
+                self._row[positions[key]] = value
+                self._changes.add(positions[key])
 
-    def get_all(self):
+    def get_all(self, records=False, prefetch=None, fields=None):
         try:
-            c = self.__execute_query(self.__class__._SQL_SELECT, self.__fields)
-            if c is None:
-                return None
-
-            fetch_tuples = c.fetchall()
-            ret_classes = list()
-
-            for line in fetch_tuples:
-
-                i = 0
-                data = {}
-                for v in self.__all_field_names:
-                    data[v] = line[i]
-                    i += 1
-                self.load_from_array(data)
-                new_self = copy.deepcopy(self)
-                ret_classes.append(new_self)
-
-            return ret_classes
+            columns = self._projection(fields)
+            if columns is not None and prefetch:
+                columns = self._projection(list(fields) + list(prefetch))
+            with self._reader() as conn:
+                rows = self.__execute_query(conn, self._sql_select(columns)).fetchall()
+            objs = self._materialize(rows, records, None, columns)
+            if prefetch and not records:
+                self._prefetch(objs, prefetch)
+            return objs
         except Exception as e:
-            print(self.__class__.__name__, '__insert -> Error -> ', e)
+            print(self.__class__.__name__, 'get_all -> Error -> ', e)
         return None
 
-    def get_sql(self, sql):
+    def get_sql(self, sql, records=False):
         try:
-            c = self.__execute_query(sql, self.__fields)
-            if c is None:
-                return None
-
-            fetch_tuples = c.fetchall()
-            ret_classes = list()
-
-            for line in fetch_tuples:
+            with self._reader() as conn:
+                rows = self.__execute_query(conn, sql).fetchall()
+            return self._materialize(rows, records)
+        except Exception as e:
+            print(self.__class__.__name__, 'get_sql -> Error -> ', e)
+        return None
 
-                i = 0
-                data = {}
-                for v in self.__all_field_names:
-                    data[v] = line[i]
-                    i += 1
-                self.load_from_array(data)
-                new_self = copy.deepcopy(self)
-                ret_classes.append(new_self)
+    def __sql_with_params(self):
+        sql = self.__class__._SQL_SELECT
+        if self._join is not None:
+            sql += self._join
+        if self._where is not None:
+            sql += self._where
+        return sql
 
-            return ret_classes
+    def get_with_params(self, records=False, prefetch=None):
+        try:
+            with self._reader() as conn:
+                rows = self.__execute_query(conn, self.__sql_with_params()).fetchall()
+            objs = self._materialize(rows, records)
+            if prefetch and not records:
+                self._prefetch(objs, prefetch)
+            return objs
         except Exception as e:
-            print(self.__class__.__name__, '__insert -> Error -> ', e)
+            print(self.__class__.__name__, '__get -> Error -> ', e)
         return None
 
-    def get_with_params(self):
-        try:
-            sql = self.__class__._SQL_SELECT
-            if self._join is not None:
-                sql += self._join
-            if self._where is not None:
-                sql += self._where
-            c = self.__execute_query(sql, self.__fields)
-            if c is not None:
-                fetch_tuples = c.fetchall()
-                ret_classes = list()
-
-                for line in fetch_tuples:
-
-                    i = 0
-                    data = {}
-                    for v in self.__all_field_names:
-                        data[v] = line[i]
-                        i += 1
-                    self.load_from_array(data)
-                    new_self = copy.deepcopy(self)
-                    ret_classes.append(new_self)
-
-                return ret_classes
-            return None
+    def __iterate(self, sql, batch_size, records):
+        assert batch_size > 0
+        try:
+            with self._reader() as conn:
+                c = self.__execute_query(conn, sql)
+                for obj in self._iterate_cursor(c, batch_size, records):
+                    yield obj
+        except EdgeModelException:
+            raise
         except Exception as e:
-            print(self.__class__.__name__, '__get -> Error -> ', e)
+            # a stream that ends early must not look complete
+            raise EdgeModelException(self.__class__.__name__ + ' iteration failed: ' + str(e), 1) from e
+
+    def iter_all(self, batch_size=1000, records=False):
+        return self.__iterate(self.__class__._SQL_SELECT, batch_size, records)
+
+    def iter_sql(self, sql, batch_size=1000, records=False):
+        return self.__iterate(sql, batch_size, records)
+
+    def iter_with_params(self, batch_size=1000, records=False):
+        return self.__iterate(self.__sql_with_params(), batch_size, records)
+
+    @classmethod
+    def _field(cls, name):
+        # model field by column name or attribute name
+        for f in getattr(cls, '__FIELDS'):
+            if f.fieldname() == name or f._attrname == name:
+                return f
+        raise EdgeModelException('Field ' + str(name) + ' is not defined in ' + cls.__name__, 1)
+
+    @classmethod
+    def query(cls):
+        cls._setup()
+        return Query(cls)
+
+    @classmethod
+    def page(cls, after=None, limit=100, order_by=None, records=False):
+        return cls.query().page(after, limit, order_by, records)
+
+    @classmethod
+    def search(cls, text, limit=20, offset=0, records=False):
+        # FTS5 query over the FullText fields, best matches (bm25 rank) first
+        cls._setup()
+        if cls._SQL_SEARCH is None:
+            raise EdgeModelException(cls.__name__ + ' has no FullText fields', 1)
+        try:
+            with cls._reader() as conn:
+                rows = cls._execute(conn, cls._SQL_SEARCH, (text, int(limit), int(offset))).fetchall()
+            return cls._materialize(rows, records)
+        except Exception as e:
+            print(cls.__name__, 'search -> Error -> ', e)
         return None
 
-    def get_by_id(self, id_search):
+    @classmethod
+    def __filtered(cls, where, params):
+        q = cls.query()
+        if where is not None:
+            q = q._where(where, params)
+        return q
+
+    # aggregates run inside sqlite; where is a SQL condition without the WHERE keyword
+
+    @classmethod
+    def count(cls, where=None, params=()):
+        return cls.__filtered(where, params).count()
+
+    @classmethod
+    def sum(cls, field, where=None, params=()):
+        return cls.__filtered(where, params).sum(field)
+
+    @classmethod
+    def avg(cls, field, where=None, params=()):
+        return cls.__filtered(where, params).avg(field)
+
+    @classmethod
+    def min(cls, field, where=None, params=()):
+        return cls.__filtered(where, params).min(field)
+
+    @classmethod
+    def max(cls, field, where=None, params=()):
+        return cls.__filtered(where, params).max(field)
+
+    @classmethod
+    def exists(cls, where=None, params=()):
+        return cls.__filtered(where, params).exists()
+
+    @classmethod
+    def group_by(cls, *names):
+        return cls.query().group_by(*names)
+
+    # set based writes, one statement for all matching rows, return the affected row count
+
+    @classmethod
+    def delete_where(cls, where=None, params=(), all=False):
+        # an unfiltered write needs all=True
+        return cls.__filtered(where, params).delete(all)
+
+    @classmethod
+    def update_where(cls, values, where=None, params=(), all=False):
+        return cls.__filtered(where, params).update(values, all)
+
+    @classmethod
+    def export(cls, dest, format='csv', where=None, params=(), fields=None, chunk_size=1000):
+        # writes the rows (where is a SQL condition) as CSV with a header row or as JSON Lines, chunk by chunk
+        if format not in ('csv', 'jsonl'):
+            raise EdgeModelException('Unknown export format ' + str(format), 1)
+        assert chunk_size > 0
+        cls._setup()
+        if fields is None:
+            names = getattr(cls, '__ALL_FIELD_NAMES')
+        else:
+            names = [cls._field(name).fieldname() for name in fields]
+        sql = 'SELECT ' + ", ".join(names) + ' FROM ' + getattr(cls, '__TABLE')
+        if where is not None:
+            sql += ' WHERE ' + where
+
+        f = _open_file(dest, 'w')
         try:
-            sql = self.__class__._SQL_SELECT + " where " + self.__keys[0] + " = " + id_search
-            c = self.__execute_query(sql, self.__fields)
-            line = c.fetchone()
+            count = 0
+            with cls._reader() as conn:
+                c = cls._execute(conn, sql + ';', params)
+                if format == 'csv':
+                    writer = csv.writer(f)
+                    writer.writerow(names)
+                rows = c.fetchmany(chunk_size)
+                while len(rows) > 0:
+                    if format == 'csv':
+                        writer.writerows(rows)
+                    else:
+                        f.write("".join(json.dumps(dict(zip(names, row))) + '\n' for row in rows))
+                    count += len(rows)
+                    rows = c.fetchmany(chunk_size)
+            return count
+        except Exception as e:
+            print(cls.__name__, 'export -> Error -> ', e)
+        finally:
+            if f is not dest:
+                f.close()
+        return None
 
-            i = 0
-            data = {}
-            for v in self.__all_field_names:
-                data[v] = line[i]
-                i += 1
-            self.load_from_array(data)
+    @classmethod
+    def fetch_columns(cls, where=None, fields=None, params=None, chunk_size=10000):
+        try:
+            import numpy
+        except ImportError:
+            raise EdgeModelException('fetch_columns requires numpy', 1)
+        assert chunk_size > 0
 
-            return self
+        if fields is None:
+            fields = getattr(cls, '__SELECT_FIELDS')
+        else:
+            fields = [cls._field(name) for name in fields]
+        names = [f.fieldname() for f in fields]
+        dtypes = []
+        for f in fields:
+            if isinstance(f, IntegerField):
+                dtypes.append(numpy.int64)
+            elif isinstance(f, RealField):
+                dtypes.append(numpy.float64)
+            else:
+                dtypes.append(object)
+
+        # where is a SQL condition without the WHERE keyword, like the other where= parameters
+        sql = 'SELECT ' + ", ".join(names) + ' FROM ' + getattr(cls, '__TABLE')
+        if where is not None:
+            sql += ' WHERE ' + where
+        with cls._reader() as conn:
+            c = cls._execute(conn, sql + ';', params if params is not None else ())
+
+            size, capacity = 0, chunk_size
+            columns = [numpy.empty(capacity, dtype=t) for t in dtypes]
+            rows = c.fetchmany(chunk_size)
+            while len(rows) > 0:
+                if size + len(rows) > capacity:
+                    capacity = max(capacity * 2, size + len(rows))
+                    for i, column in enumerate(columns):
+                        grown = numpy.empty(capacity, dtype=column.dtype)
+                        grown[:size] = column[:size]
+                        columns[i] = grown
+                for i, values in enumerate(zip(*rows)):
+                    # NULLs in an INTEGER column turn it into a float column with NaN
+                    if columns[i].dtype == numpy.int64 and None in values:
+                        columns[i] = columns[i].astype(numpy.float64)
+                    columns[i][size:size + len(rows)] = values
+                size += len(rows)
+                rows = c.fetchmany(chunk_size)
+
+        return collections.OrderedDict((name, column[:size].copy()) for name, column in zip(names, columns))
 
+    def get_by_id(self, id_search):
+        try:
+            if isinstance(getattr(self.__class__, '__KEYS')[0], IntegerField) and isinstance(id_search, str):
+                id_search = int(id_search)
+            self._row[0] = id_search
+            if self.load():
+                return self
         except Exception as e:
-            print(self.__class__.__name__, '__insert -> Error -> ', e)
+            print(self.__class__.__name__, 'get_by_id -> Error -> ', e)
         return None
 
     def join(self, value):
@@ -670,3 +2149,424 @@ class EdgeModel(object):
     def where(self, value):
         self._where = value
         return self
+
+    @classmethod
+    def parallel_scan(cls, fn, workers=None, where=None, params=(), reduce=None, chunk_size=10000, records=False):
+        # fn (and reduce) must be picklable, e.g. module level functions
+        assert chunk_size > 0
+        path = cls._database.get_database_path() if cls._database is not None else None
+        if path is None or path == '' or path == ':memory:':
+            raise EdgeModelException('parallel_scan requires a database file', 1)
+        with cls._reader() as conn:
+            first, last = conn.execute('SELECT MIN(rowid), MAX(rowid) FROM ' + getattr(cls, '__TABLE') + ';').fetchone()
+        if first is None:
+            return None if reduce is not None else []
+
+        ranges = [(start, min(start + chunk_size - 1, last)) for start in range(first, last + 1, chunk_size)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_scan_partition, cls, path, fn, start, end, where, list(params), records)
+                       for start, end in ranges]
+            results = [f.result() for f in futures]
+        if reduce is not None:
+            return functools.reduce(reduce, results)
+        return results
+
+    @classmethod
+    def __async_database(cls):
+        if not isinstance(cls._database, AsyncDatabase):
+            raise EdgeModelException(cls.__name__ + ' is not bound to an AsyncDatabase', 1)
+        return cls._database
+
+    async def asave(self):
+        return await self.__async_database().run_write(self.save)
+
+    async def adelete(self):
+        return await self.__async_database().run_write(self.delete)
+
+    async def aload(self):
+        return await self.__async_database().run(self.load)
+
+    @classmethod
+    async def aget_all(cls, records=False, prefetch=None):
+        return await cls.__async_database().run(cls().get_all, records, prefetch)
+
+    @classmethod
+    async def aiter(cls, query=None, batch_size=1000, records=False):
+        db = cls.__async_database()
+        if query is None:
+            query = cls.query()
+        # the cursor stays open across awaits, so it must not hold one of the workers' pooled readers
+        iterator = query._iter(db.stream_reader, batch_size, records)
+        try:
+            while True:
+                batch = await db.run(_next_batch, iterator, batch_size)
+                if len(batch) == 0:
+                    break
+                for obj in batch:
+                    yield obj
+        finally:
+            await db.run(iterator.close)
+
+
+class Query(object):
+
+    OPERATORS = {'eq': '=', 'ne': '<>', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<=',
+                 'in': 'IN', 'like': 'LIKE', 'isnull': 'IS NULL'}
+    AGGREGATES = {'count': 'COUNT', 'sum': 'SUM', 'avg': 'AVG', 'min': 'MIN', 'max': 'MAX'}
+
+    def __init__(self, model):
+        self._model = model
+        self._filters = []
+        self._order_by = []
+        self._limit = None
+        self._offset = None
+        self._prefetch = []
+        self._only = None
+        self._defer = []
+        self._conditions = []
+        self._group_by = []
+
+    def _clone(self):
+        q = self.__class__.__new__(self.__class__)
+        q.__dict__.update(self.__dict__)
+        q._filters = list(self._filters)
+        q._order_by = list(self._order_by)
+        q._prefetch = list(self._prefetch)
+        q._defer = list(self._defer)
+        q._conditions = list(self._conditions)
+        q._group_by = list(self._group_by)
+        return q
+
+    def only(self, *names):
+        q = self._clone()
+        q._only = list(names)
+        return q
+
+    def defer(self, *names):
+        q = self._clone()
+        q._defer.extend(names)
+        return q
+
+    def _columns(self):
+        if self._only is not None:
+            return self._model._projection(self._only + self._prefetch)
+        return self._model._projection(None, [n for n in self._defer if n not in self._prefetch])
+
+    def prefetch(self, *names):
+        q = self._clone()
+        for name in names:
+            if not self._model._field(name).is_foreign_key():
+                raise EdgeModelException('Field ' + str(name) + ' is not a foreign key', 1)
+            q._prefetch.append(name)
+        return q
+
+    def filter(self, **kwargs):
+        q = self._clone()
+        for name, value in kwargs.items():
+            op = 'eq'
+            if '__' in name and name.rsplit('__', 1)[1] in self.OPERATORS:
+                name, op = name.rsplit('__', 1)
+            field = self._model._field(name)
+            if isinstance(value, EdgeModel):
+                value = value.get_keys()[0].get_value()
+            if op == 'in':
+                value = [v.get_keys()[0].get_value() if isinstance(v, EdgeModel) else v for v in value]
+            q._filters.append((field.fieldname(), op, value))
+        # canonical order so the same filter shape always produces the same SQL text
+        q._filters.sort(key=lambda f: (f[0], f[1]))
+        return q
+
+    def order_by(self, *names):
+        q = self._clone()
+        for name in names:
+            desc = name.startswith('-')
+            q._order_by.append((self._model._field(name.lstrip('-')).fieldname(), desc))
+        return q
+
+    def _where(self, condition, params=()):
+        # raw SQL condition for the Model.count(where, params) style helpers
+        q = self._clone()
+        q._conditions.append((condition, list(params)))
+        return q
+
+    def limit(self, limit):
+        q = self._clone()
+        q._limit = int(limit)
+        return q
+
+    def offset(self, offset):
+        q = self._clone()
+        q._offset = int(offset)
+        return q
+
+    def _where_sql(self):
+        clauses, params = [], []
+        for column, op, value in self._filters:
+            if op == 'isnull':
+                clauses.append(column + (' IS NULL' if value else ' IS NOT NULL'))
+            elif op == 'in':
+                values = list(value)
+                if len(values) == 0:
+                    clauses.append('0')
+                    continue
+                # pad IN lists to a power of two so they share a handful of prepared statements
+                size = 1
+                while size < len(values):
+                    size *= 2
+                if size <= SQL_MAX_VARIABLES:
+                    values += [values[-1]] * (size - len(values))
+                clauses.append(column + ' IN (' + ",".join('?' for _ in values) + ')')
+                params.extend(values)
+            elif value is None and op in ('eq', 'ne'):
+                clauses.append(column + (' IS NULL' if op == 'eq' else ' IS NOT NULL'))
+            else:
+                clauses.append(column + ' ' + self.OPERATORS[op] + ' ?')
+                params.append(value)
+        for condition, values in self._conditions:
+            clauses.append('(' + condition + ')')
+            params.extend(values)
+        if len(clauses) == 0:
+            return '', params
+        return ' WHERE ' + " AND ".join(clauses), params
+
+    def sql(self):
+        where, params = self._where_sql()
+        s = self._model._sql_select(self._columns()).rstrip() + where
+        if len(self._order_by) > 0:
+            s += ' ORDER BY ' + ", ".join(c + (' DESC' if desc else '') for c, desc in self._order_by)
+        if self._limit is not None or self._offset is not None:
+            s += ' LIMIT ? OFFSET ?'
+            params.append(self._limit if self._limit is not None else -1)
+            params.append(self._offset if self._offset is not None else 0)
+        return s + ';', params
+
+    def _execute(self, conn):
+        sql, params = self.sql()
+        return self._model._execute(conn, sql, params)
+
+    def _source(self):
+        # FROM clause of the aggregates, a LIMIT/OFFSET is honoured through a subquery
+        if self._limit is None and self._offset is None:
+            where, params = self._where_sql()
+            return getattr(self._model, '__TABLE') + where, params
+        q = self._clone()
+        q._only, q._defer, q._prefetch = None, [], []
+        sql, params = q.sql()
+        return '(' + sql.rstrip(';') + ')', params
+
+    def _aggregate_expression(self, spec):
+        if spec == 'count':
+            return 'COUNT(*)'
+        if '__' not in spec or spec.rsplit('__', 1)[1] not in self.AGGREGATES:
+            raise EdgeModelException('Aggregate ' + str(spec) + ' is not supported', 1)
+        name, fn = spec.rsplit('__', 1)
+        return self.AGGREGATES[fn] + '(' + self._model._field(name).fieldname() + ')'
+
+    def _fetch_aggregate(self, sql, params):
+        try:
+            with self._model._reader() as conn:
+                return self._model._execute(conn, sql, params).fetchall()
+        except Exception as e:
+            print(self._model.__name__, 'aggregate -> Error -> ', e)
+        return None
+
+    def __scalar(self, expression):
+        source, params = self._source()
+        rows = self._fetch_aggregate('SELECT ' + expression + ' FROM ' + source + ';', params)
+        return rows[0][0] if rows is not None else None
+
+    def count(self):
+        return self.__scalar('COUNT(*)')
+
+    def sum(self, name):
+        return self.__scalar(self._aggregate_expression(name + '__sum'))
+
+    def avg(self, name):
+        return self.__scalar(self._aggregate_expression(name + '__avg'))
+
+    def min(self, name):
+        return self.__scalar(self._aggregate_expression(name + '__min'))
+
+    def max(self, name):
+        return self.__scalar(self._aggregate_expression(name + '__max'))
+
+    def exists(self):
+        source, params = self._source()
+        rows = self._fetch_aggregate('SELECT EXISTS (SELECT 1 FROM ' + source + ');', params)
+        return bool(rows[0][0]) if rows is not None else None
+
+    def _write_where(self):
+        # UPDATE/DELETE ... LIMIT needs a sqlite compile option, a limit selects the rowids instead
+        where, params = self._where_sql()
+        if self._limit is None and self._offset is None:
+            return where, params
+        s = ' WHERE rowid IN (SELECT rowid FROM ' + getattr(self._model, '__TABLE') + where
+        if len(self._order_by) > 0:
+            s += ' ORDER BY ' + ", ".join(c + (' DESC' if desc else '') for c, desc in self._order_by)
+        params.append(self._limit if self._limit is not None else -1)
+        params.append(self._offset if self._offset is not None else 0)
+        return s + ' LIMIT ? OFFSET ?)', params
+
+    def _write(self, sql, params, name):
+        model = self._model
+        try:
+            with model._writer() as conn:
+                r = model._execute(conn, sql, params)
+                if model._database is not None:
+                    model._database.commit()
+                else:
+                    model._db.commit()
+            # the affected keys are unknown, drop every cached row of the model
+            if model._database is not None and model._database.cache() is not None:
+                model._database.cache().invalidate(model)
+            return r.rowcount
+        except Exception as e:
+            print(model.__name__, name + ' -> Error -> ', e)
+        return None
+
+    def _check_filtered(self, all):
+        if not all and len(self._filters) == 0 and len(self._conditions) == 0 and self._limit is None:
+            raise EdgeModelException('Unfiltered ' + self._model.__name__ + ' write, pass all=True to touch every row', 1)
+
+    def delete(self, all=False):
+        self._check_filtered(all)
+        where, params = self._write_where()
+        return self._write('DELETE FROM ' + getattr(self._model, '__TABLE') + where + ';', params, 'delete')
+
+    def update(self, values, all=False):
+        # values maps field names to new values, model instances are stored by primary key
+        if len(values) == 0:
+            raise EdgeModelException('update needs at least one value', 1)
+        self._check_filtered(all)
+        columns, params = [], []
+        for name, value in values.items():
+            columns.append(self._model._field(name).fieldname() + ' = ?')
+            if isinstance(value, EdgeModel):
+                value = value.get_keys()[0].get_value()
+            params.append(value)
+        where, where_params = self._write_where()
+        return self._write('UPDATE ' + getattr(self._model, '__TABLE') + ' SET ' + ", ".join(columns) + where + ';',
+                           params + where_params, 'update')
+
+    def group_by(self, *names):
+        q = self._clone()
+        q._group_by.extend(self._model._field(name).fieldname() for name in names)
+        return q
+
+    def aggregate(self, *specs):
+        # specs are 'count' or '<field>__<count|sum|avg|min|max>'; grouped queries return one tuple per group
+        if len(specs) == 0:
+            specs = ('count',)
+        expressions = [self._aggregate_expression(spec) for spec in specs]
+        source, params = self._source()
+        sql = 'SELECT ' + ", ".join(self._group_by + expressions) + ' FROM ' + source
+        if len(self._group_by) > 0:
+            sql += ' GROUP BY ' + ", ".join(self._group_by)
+            if len(self._order_by) > 0 and self._limit is None and self._offset is None:
+                sql += ' ORDER BY ' + ", ".join(c + (' DESC' if desc else '') for c, desc in self._order_by)
+            else:
+                sql += ' ORDER BY ' + ", ".join(self._group_by)
+        rows = self._fetch_aggregate(sql + ';', params)
+        if rows is None:
+            return None
+        rows = [tuple(row) for row in rows]
+        return rows if len(self._group_by) > 0 else rows[0]
+
+    def all(self, records=False):
+        try:
+            with self._model._reader() as conn:
+                rows = self._execute(conn).fetchall()
+            objs = self._model._materialize(rows, records, None, self._columns())
+            if len(self._prefetch) > 0 and not records:
+                self._model._prefetch(objs, self._prefetch)
+            return objs
+        except Exception as e:
+            print(self._model.__name__, 'query -> Error -> ', e)
+        return None
+
+    def first(self, records=False):
+        rows = self.limit(1).all(records)
+        if rows is not None and len(rows) > 0:
+            return rows[0]
+        return None
+
+    def page(self, after=None, limit=100, order_by=None, records=False):
+        # keyset pagination: seeks past the previous page's last (order column, key) instead of OFFSET
+        keys = getattr(self._model, '__KEYS')
+        if len(keys) != 1:
+            raise EdgeModelException('page() requires a single primary key', 1)
+        key = keys[0].fieldname()
+        column, desc = None, False
+        if order_by is not None:
+            desc = order_by.startswith('-')
+            column = self._model._field(order_by.lstrip('-')).fieldname()
+            if column == key:
+                column = None
+
+        columns = self._columns()
+        if columns is not None and column is not None and column not in columns:
+            columns = [c for c in getattr(self._model, '__ALL_FIELD_NAMES') if c in columns or c == column]
+        names = columns if columns is not None else getattr(self._model, '__ALL_FIELD_NAMES')
+
+        where, params = self._where_sql()
+        if after is not None:
+            op = ' < ' if desc else ' > '
+            if column is None:
+                condition = key + op + '?'
+                params.append(after)
+            elif after[0] is None:
+                # sqlite sorts NULLs first ascending and last descending, a row value compared to NULL is never true
+                condition = '(' + column + ' IS NULL AND ' + key + op + '?)'
+                if not desc:
+                    condition = '(' + condition + ' OR ' + column + ' IS NOT NULL)'
+                params.append(after[1])
+            else:
+                condition = '(' + column + ', ' + key + ')' + op + '(?, ?)'
+                if desc:
+                    condition = '(' + condition + ' OR ' + column + ' IS NULL)'
+                params.extend(after)
+            where += (' AND ' if where else ' WHERE ') + condition
+        order = [key] if column is None else [column, key]
+        sql = self._model._sql_select(columns).rstrip() + where + ' ORDER BY ' + \
+            ", ".join(c + (' DESC' if desc else '') for c in order) + ' LIMIT ?;'
+        # one row more than the page tells whether there is a next one
+        params.append(int(limit) + 1)
+
+        try:
+            with self._model._reader() as conn:
+                rows = self._model._execute(conn, sql, params).fetchall()
+        except Exception as e:
+            print(self._model.__name__, 'page -> Error -> ', e)
+            return None, None
+
+        next_after = None
+        more = len(rows) > int(limit)
+        rows = rows[:int(limit)]
+        if more and len(rows) > 0:
+            last = rows[-1]
+            if column is None:
+                next_after = last[names.index(key)]
+            else:
+                next_after = (last[names.index(column)], last[names.index(key)])
+        objs = self._model._materialize(rows, records, None, columns)
+        if len(self._prefetch) > 0 and not records:
+            self._model._prefetch(objs, self._prefetch)
+        return objs, next_after
+
+    def iter(self, batch_size=1000, records=False):
+        return self._iter(self._model._reader, batch_size, records)
+
+    def _iter(self, reader, batch_size, records):
+        assert batch_size > 0
+        try:
+            with reader() as conn:
+                for obj in self._model._iterate_cursor(self._execute(conn), batch_size, records, self._prefetch,
+                                                       self._columns()):
+                    yield obj
+        except EdgeModelException:
+            raise
+        except Exception as e:
+            raise EdgeModelException(self._model.__name__ + ' query iteration failed: ' + str(e), 1) from e
+
+    def __iter__(self):
+        return self.iter()
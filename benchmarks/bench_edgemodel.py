@@ -0,0 +1,257 @@
+import argparse
+import gc
+import json
+import os
+import os.path
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from EdgeModel.EdgeModel import *  # noqa: E402
+
+
+class Bank(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'bank'
+        self.id_bank = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_bank')
+        self.name = TextField(NotNull, Unique, FieldName='name')
+
+
+class Card(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'card'
+        self.id_card = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_card')
+        self.description = TextField(Unique, FieldName='description')
+        self.id_bank = IntegerField(NotNull, ForeignModel=Bank, FieldName='id_bank')
+
+
+BANKS = 100
+
+
+def open_database(kind, workdir, cache_size=0):
+    if kind == 'memory':
+        path = ':memory:'
+    else:
+        path = os.path.join(workdir, 'bench.db')
+    db = Database()
+    db.open(path, True, cache_size=cache_size)
+    db.create_tables([Bank, Card])
+    db.bulk_insert(Bank, ({'name': 'bank ' + str(i)} for i in range(BANKS)))
+    return db
+
+
+def fill_cards(db, rows):
+    db.bulk_insert(Card, ({'description': 'card ' + str(i), 'id_bank': i % BANKS + 1} for i in range(rows)),
+                   chunk_size=10000)
+
+
+def new_bank(i):
+    b = Bank()
+    b.name.set_value('new bank ' + str(i))
+    return b
+
+
+def bench_instantiate(db, rows):
+    for _ in range(rows):
+        Card()
+    return rows
+
+
+def bench_save_insert(db, rows):
+    for i in range(rows):
+        new_bank(i).save()
+    return rows
+
+
+def bench_save_update(db, rows):
+    b = Bank().get_by_id(1)
+    for i in range(rows):
+        b.name.set_value('renamed ' + str(i))
+        b.save()
+    return rows
+
+
+def bench_save_many(db, rows):
+    Bank.save_many([new_bank(i) for i in range(rows)], chunk_size=1000)
+    return rows
+
+
+def bench_bulk_insert(db, rows):
+    db.bulk_insert(Bank, ({'name': 'bulk bank ' + str(i)} for i in range(rows)), chunk_size=1000)
+    return rows
+
+
+def bench_get_all(db, rows):
+    return len(Card().get_all())
+
+
+def bench_get_all_records(db, rows):
+    return len(Card().get_all(records=True))
+
+
+def bench_iter_all(db, rows):
+    return sum(1 for _ in Card().iter_all(batch_size=1000))
+
+
+def bench_load(db, rows):
+    ids = [random.randint(1, rows) for _ in range(min(rows, 10000))]
+    for id_card in ids:
+        c = Card()
+        c.id_card.set_value(id_card)
+        c.load()
+    return len(ids)
+
+
+def bench_get_by_id(db, rows):
+    ids = [random.randint(1, BANKS) for _ in range(min(rows, 10000))]
+    for id_bank in ids:
+        Bank().get_by_id(id_bank)
+    return len(ids)
+
+
+def bench_foreign_lazy(db, rows):
+    cards = Card.query().limit(10000).all()
+    for c in cards:
+        c.id_bank.get_object()
+    return len(cards)
+
+
+def bench_foreign_prefetch(db, rows):
+    cards = Card.query().limit(10000).prefetch('id_bank').all()
+    for c in cards:
+        c.id_bank.get_object()
+    return len(cards)
+
+
+# name, function, needs the card table filled, size cap (single row writes fsync on file databases)
+BENCHMARKS = [
+    ('instantiate', bench_instantiate, False, 100000),
+    ('save_insert', bench_save_insert, False, 2000),
+    ('save_update', bench_save_update, False, 2000),
+    ('save_many', bench_save_many, False, None),
+    ('bulk_insert', bench_bulk_insert, False, None),
+    ('get_all', bench_get_all, True, None),
+    ('get_all_records', bench_get_all_records, True, None),
+    ('iter_all', bench_iter_all, True, None),
+    ('load', bench_load, True, None),
+    ('get_by_id', bench_get_by_id, True, None),
+    ('get_by_id_cached', bench_get_by_id, True, None),
+    ('foreign_lazy', bench_foreign_lazy, True, None),
+    ('foreign_prefetch', bench_foreign_prefetch, True, None),
+]
+
+
+def run_one(name, fn, kind, rows, filled, measure_memory):
+    result = {'name': name, 'db': kind, 'rows': rows}
+    passes = [False, True] if measure_memory else [False]
+    for traced in passes:
+        # fresh database per pass so both passes see the same data
+        workdir = tempfile.mkdtemp(prefix='edgemodel-bench-')
+        db = open_database(kind, workdir, cache_size=1024 if name.endswith('_cached') else 0)
+        if filled:
+            fill_cards(db, rows)
+        gc.collect()
+        if traced:
+            tracemalloc.start()
+            fn(db, rows)
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            ops = fn(db, rows)
+            elapsed = time.perf_counter() - start
+            result['ops'] = ops
+            result['seconds'] = elapsed
+            result['ops_per_sec'] = ops / elapsed if elapsed > 0 else None
+        db.close()
+        if kind == 'file':
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                if os.path.isfile(os.path.join(workdir, 'bench.db' + suffix)):
+                    os.remove(os.path.join(workdir, 'bench.db' + suffix))
+        os.rmdir(workdir)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = dict(((r['name'], r['db'], r['rows']), r) for r in json.load(f)['results'])
+    for r in results:
+        old = baseline.get((r['name'], r['db'], r['rows']))
+        if old is None or not old.get('ops_per_sec') or not r.get('ops_per_sec'):
+            continue
+        sys.stderr.write('%-18s %-6s %8d  %12.1f -> %12.1f ops/s  x%.2f\n' % (
+            r['name'], r['db'], r['rows'], old['ops_per_sec'], r['ops_per_sec'],
+            r['ops_per_sec'] / old['ops_per_sec']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EdgeModel hot path benchmarks, results as JSON')
+    parser.add_argument('--sizes', default='10000,100000', help='comma separated row counts, e.g. 10000,100000,1000000')
+    parser.add_argument('--db', default='memory,file', help='comma separated database kinds: memory, file')
+    parser.add_argument('--only', default=None, help='comma separated benchmark names')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass for peak memory')
+    parser.add_argument('--output', default=None, help='write JSON here instead of stdout')
+    parser.add_argument('--compare', default=None, help='previous JSON output to print speedups against')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    kinds = args.db.split(',')
+    only = set(args.only.split(',')) if args.only else None
+
+    # the library reports on stdout, keep it free for the JSON report
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    results = []
+    for kind in kinds:
+        for rows in sizes:
+            for name, fn, filled, cap in BENCHMARKS:
+                if only is not None and name not in only:
+                    continue
+                n = rows if cap is None else min(rows, cap)
+                result = run_one(name, fn, kind, n, filled, not args.no_memory)
+                sys.stderr.write('%-18s %-6s %8d  %12.1f ops/s\n' % (name, kind, n, result['ops_per_sec'] or 0))
+                results.append(result)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    sys.stdout = stdout
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
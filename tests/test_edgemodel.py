@@ -0,0 +1,1163 @@
+import asyncio
+import io
+import json
+import operator
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from EdgeModel.EdgeModel import *  # noqa: E402
+
+
+class Bank(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'bank'
+        self.id_bank = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_bank')
+        self.name = TextField(NotNull, Unique, FieldName='name')
+
+
+class Card(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'card'
+        self.id_card = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_card')
+        self.description = TextField(Unique, FieldName='description')
+        self.id_bank = IntegerField(NotNull, ForeignModel=Bank, FieldName='id_bank')
+
+
+def run_with_timeout(test, fn, timeout=30):
+    # a deadlock fails the test instead of hanging the run
+    results = []
+    thread = threading.Thread(target=lambda: results.append(fn()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    test.assertFalse(thread.is_alive(), 'deadlocked')
+    return results[0]
+
+
+class Payment(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'payment'
+        self.amount = RealField(FieldName='amount')
+        self.id_payment = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_payment')
+        self.id_bank = IntegerField(ForeignModel=Bank, FieldName='id_bank')
+        self.note = TextField(FieldName='note')
+
+
+class Setting(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'setting'
+        self.name = TextField(PrimaryKey, FieldName='name')
+        self.weight = RealField(FieldName='weight')
+
+
+def new_bank(name):
+    b = Bank()
+    b.name.set_value(name)
+    return b
+
+
+class ModelDefinitionTest(unittest.TestCase):
+
+    def test_define_model_runs_once(self):
+        calls = []
+
+        class Counted(EdgeModel):
+
+            def __define_model__(self):
+                calls.append(1)
+                self.table_name = 'counted'
+                self.id_counted = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_counted')
+                self.label = TextField(FieldName='label')
+
+        objs = [Counted() for _ in range(100)]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(objs[0]._row, [None, None])
+        self.assertEqual(Counted._SQL_SELECT.strip(), 'SELECT id_counted, label FROM counted')
+
+    def test_fields_are_bound_per_instance(self):
+        a, b = Bank(), Bank()
+        a.name.set_value('a')
+        self.assertIs(a.name, a.name)
+        self.assertIsNot(a.name, b.name)
+        self.assertIsNone(b.name.get_value())
+        self.assertEqual(a._row, [None, 'a'])
+        # the class keeps the unbound definition
+        self.assertIsInstance(Bank.name, TextField)
+        self.assertIs(a.name._properties, Bank.name._properties)
+
+    def test_forward_reference(self):
+        class Child(EdgeModel):
+
+            def __define_model__(self):
+                self.table_name = 'child'
+                self.id_child = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_child')
+                self.id_parent = IntegerField(ForeignModel=Parent, FieldName='id_parent')
+
+        class Parent(EdgeModel):
+
+            def __define_model__(self):
+                self.table_name = 'parent'
+                self.id_parent = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_parent')
+
+        # Child could not be set up before Parent existed, it is on first use
+        self.assertIs(Child().id_parent.property(PT.ForeignModel), Parent)
+
+
+class SaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:', cache_size=16)
+        self.db.create_tables([Bank, Payment])
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_saved_keys_are_int(self):
+        b = Bank()
+        b.name.set_value('bank')
+        self.assertTrue(b.save())
+        p = Payment()
+        p.amount.set_value(1.5)
+        p.id_bank.set_value(b)
+        p.note.set_value('q')
+        self.assertTrue(p.save())
+        self.assertIs(type(p.id_payment.get_value()), int)
+        self.assertIs(type(p.id_bank.get_value()), int)
+        self.assertIs(type(p.amount.get_value()), float)
+        other = Payment()
+        other.id_payment.set_value(p.id_payment.get_value())
+        self.assertIs(type(Payment().get_by_id(p.id_payment.get_value()).id_payment.get_value()), int)
+
+
+    def test_upsert_updates_the_existing_row(self):
+        b = new_bank('bank')
+        b.save()
+        p = Payment()
+        p.amount.set_value(2.0)
+        p.id_bank.set_value(b)
+        p.save()
+        key = p.id_payment.get_value()
+        again = Payment()
+        again.id_payment.set_value(key)
+        again.amount.set_value(3.0)
+        again.note.set_value('second')
+        self.assertTrue(again.save())
+        self.assertEqual(Payment.count(), 1)
+        self.assertIs(type(again.id_payment.get_value()), int)
+        self.assertIs(type(again.amount.get_value()), float)
+        self.assertIsNone(again.id_bank.get_value())
+        loaded = Payment().get_by_id(key)
+        self.assertEqual((loaded.amount.get_value(), loaded.note.get_value()), (3.0, 'second'))
+
+    def test_upsert_keeps_the_rowid(self):
+        self.db.create_tables([Setting])
+        s = Setting()
+        s.name.set_value('limit')
+        s.weight.set_value(1.5)
+        s.save()
+        rowid = self.db.connection().execute('SELECT rowid FROM setting;').fetchone()[0]
+        s = Setting()
+        s.name.set_value('limit')
+        s.weight.set_value(2.5)
+        self.assertTrue(s.save())
+        # ON CONFLICT DO UPDATE, not a delete and insert like REPLACE
+        self.assertEqual(self.db.connection().execute('SELECT rowid, weight FROM setting;').fetchall(),
+                         [(rowid, 2.5)])
+        self.assertEqual(s.name.get_value(), 'limit')
+
+    def test_save_many_back_fills_keys_across_chunks(self):
+        new_bank('first').save()
+        banks = [new_bank('bank ' + str(i)) for i in range(10)]
+        self.assertTrue(Bank.save_many(banks, chunk_size=3))
+        self.assertEqual([b.id_bank.get_value() for b in banks], list(range(2, 12)))
+        self.assertFalse(any(b.is_dirty() for b in banks))
+        self.assertEqual([Bank().get_by_id(i).name.get_value() for i in (2, 11)], ['bank 0', 'bank 9'])
+
+    def test_save_many_mixes_updates_and_inserts(self):
+        banks = [new_bank('bank ' + str(i)) for i in range(5)]
+        Bank.save_many(banks, chunk_size=2)
+        banks[1].name.set_value('renamed')
+        banks += [new_bank('new ' + str(i)) for i in range(3)]
+        self.assertTrue(Bank.save_many(banks, chunk_size=2))
+        self.assertEqual([b.id_bank.get_value() for b in banks], list(range(1, 9)))
+        self.assertEqual(sorted(b.name.get_value() for b in Bank().get_all()),
+                         ['bank 0', 'bank 2', 'bank 3', 'bank 4', 'new 0', 'new 1', 'new 2', 'renamed'])
+
+    def test_bulk_insert(self):
+        self.assertEqual(self.db.bulk_insert(Bank, [(None, 'tuple'), {'name': 'dict'}, (10, 'keyed')]), 3)
+        self.assertEqual([(b.id_bank.get_value(), b.name.get_value()) for b in Bank().get_all()],
+                         [(1, 'tuple'), (2, 'dict'), (10, 'keyed')])
+        self.assertEqual(self.db.bulk_insert(Bank, ({'name': 'gen ' + str(i)} for i in range(7)), chunk_size=3), 7)
+        self.assertEqual(Bank.count(), 10)
+
+    def test_bulk_insert_commits_each_chunk(self):
+        rows = [{'name': 'bank ' + str(i)} for i in range(5)] + [{'name': 'bank 0'}]
+        self.assertIsNone(self.db.bulk_insert(Bank, rows, chunk_size=2))
+        # the first two chunks were committed before the duplicate name failed the third
+        self.assertEqual(Bank.count(), 4)
+        self.assertFalse(self.db.in_transaction())
+
+
+class TransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Bank])
+
+    def tearDown(self):
+        self.db.close()
+
+    def names(self):
+        return sorted(b.name.get_value() for b in Bank().get_all())
+
+    def test_commit(self):
+        with self.db.transaction():
+            self.assertTrue(new_bank('a').save())
+            self.assertTrue(self.db.in_transaction())
+        self.assertFalse(self.db.in_transaction())
+        self.db.connection().rollback()
+        self.assertEqual(self.names(), ['a'])
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                new_bank('a').save()
+                raise ValueError()
+        self.assertEqual(self.names(), [])
+
+    def test_savepoint_rollback_keeps_outer_block(self):
+        with self.db.transaction():
+            new_bank('outer').save()
+            with self.assertRaises(ValueError):
+                with self.db.transaction():
+                    new_bank('inner').save()
+                    with self.db.transaction():
+                        new_bank('innermost').save()
+                    raise ValueError()
+            with self.db.transaction():
+                new_bank('second').save()
+        self.assertEqual(self.names(), ['outer', 'second'])
+
+    def test_outer_rollback_discards_released_savepoints(self):
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                with self.db.transaction():
+                    new_bank('inner').save()
+                raise ValueError()
+        self.assertEqual(self.names(), [])
+        with self.db.transaction():
+            new_bank('after').save()
+        self.assertEqual(self.names(), ['after'])
+
+
+class IterationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Bank])
+        self.db.bulk_insert(Bank, ({'name': 'bank ' + str(i)} for i in range(25)))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_iter_all_batches(self):
+        self.assertEqual([b.name.get_value() for b in Bank().iter_all(batch_size=4)],
+                         ['bank ' + str(i) for i in range(25)])
+        self.assertEqual(len(list(Bank().iter_all(batch_size=4, records=True))), 25)
+
+    def test_iter_with_params(self):
+        # the instance's own values are the named parameters
+        bank = Bank()
+        bank.name.set_value('bank 1%')
+        names = [b.name.get_value() for b in bank.where(' WHERE name LIKE :name').iter_with_params(batch_size=3)]
+        self.assertEqual(names, ['bank 1'] + ['bank 1' + str(i) for i in range(10)])
+        records = list(Bank().iter_sql('SELECT id_bank, name FROM bank WHERE id_bank > 20;', batch_size=2,
+                                       records=True))
+        self.assertEqual([r.id_bank for r in records], [21, 22, 23, 24, 25])
+
+    def test_iteration_errors_propagate(self):
+        with self.assertRaises(EdgeModelException):
+            list(Bank().iter_sql('SELECT * FROM no_such_table;'))
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Bank, Card])
+        self.db.bulk_insert(Bank, ({'name': 'bank ' + str(i)} for i in range(3)))
+        self.db.bulk_insert(Card, ({'description': 'card ' + str(i), 'id_bank': i % 3 + 1} for i in range(30)))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_query_iteration_errors_propagate(self):
+        with self.assertRaises(EdgeModelException):
+            list(Card.query().filter(bogus=1))
+        with self.assertRaises(EdgeModelException):
+            list(Card.query()._where('bogus = ?', (1,)).iter(batch_size=5))
+
+
+class QueryBuilderTest(QueryTest):
+
+    def test_values_are_bound(self):
+        hostile = "card 1' OR '1'='1"
+        sql, params = Card.query().filter(description=hostile).sql()
+        self.assertNotIn(hostile, sql)
+        self.assertEqual(params, [hostile])
+        self.assertEqual(Card.query().filter(description=hostile).all(), [])
+        self.assertEqual(Card.count('description = ?', (hostile,)), 0)
+
+    def test_lookups(self):
+        def keys(q):
+            return [c.id_card.get_value() for c in q.order_by('id_card').all()]
+        self.assertEqual(keys(Card.query().filter(id_card__gt=27)), [28, 29, 30])
+        self.assertEqual(keys(Card.query().filter(id_card__lte=2)), [1, 2])
+        self.assertEqual(keys(Card.query().filter(id_bank=Bank().get_by_id(2), id_card__lt=10)), [2, 5, 8])
+        self.assertEqual(keys(Card.query().filter(description__like='card 2_')), list(range(21, 31)))
+        self.assertEqual(len(keys(Card.query().filter(id_bank__ne=1))), 20)
+        self.assertEqual(keys(Card.query().filter(description__isnull=True)), [])
+        self.assertEqual(keys(Card.query().filter(description=None)), [])
+        self.assertEqual(len(keys(Card.query().filter(description__ne=None))), 30)
+        self.assertEqual(keys(Card.query().filter(id_card__gt=10).limit(2).offset(3)), [14, 15])
+
+    def test_in_lists(self):
+        self.assertEqual(Card.query().filter(id_card__in=[]).all(), [])
+        self.assertEqual(Card.query().filter(id_card__in=[Card().get_by_id(4), 5]).count(), 2)
+        # IN lists are padded to a power of two, similar lists share one statement
+        self.assertEqual(Card.query().filter(id_card__in=[1, 2, 3]).sql()[0],
+                         Card.query().filter(id_card__in=[4, 5, 6, 7]).sql()[0])
+        self.assertEqual(Card.query().filter(id_card__in=[1, 2, 3]).sql()[1], [1, 2, 3, 3])
+        self.assertEqual(Card.query().filter(id_card__in=range(1, 2501)).count(), 30)
+        self.assertEqual(Card.query().filter(id_card__in=range(25, 2501)).delete(), 6)
+
+
+class InstrumentationTest(QueryTest):
+
+    def test_stats_per_shape(self):
+        events = []
+        metrics = self.db.instrument(callback=events.append)
+        Card().get_by_id(1)
+        Card().get_by_id(2)
+        self.assertEqual(len(list(Card().iter_all(batch_size=7))), 30)
+        stats = metrics.stats()
+        by_key = [v for k, v in stats.items() if 'WHERE' in k and 'id_card' in k]
+        self.assertEqual((by_key[0]['count'], by_key[0]['rows']), (2, 2))
+        # fetchmany batches are recorded once, when the cursor is exhausted
+        scans = [v for k, v in stats.items() if 'WHERE' not in k]
+        self.assertEqual((scans[0]['count'], scans[0]['rows']), (1, 30))
+        self.assertEqual(sum(scans[0]['histogram']), 1)
+        self.assertEqual(len(events), 3)
+        self.assertIsInstance(events[0], QueryEvent)
+        metrics.reset()
+        self.assertEqual(metrics.stats(), {})
+
+    def test_shapes_replace_literals(self):
+        metrics = QueryInstrumentation()
+        self.assertEqual(metrics.shape("SELECT *  FROM card WHERE id_card = 12 AND description = 'it''s'"),
+                         'SELECT * FROM card WHERE id_card = ? AND description = ?')
+
+    def test_commits_and_slow_queries(self):
+        metrics = self.db.instrument(slow_query_ms=0)
+        with self.assertLogs('EdgeModel', 'WARNING') as logs:
+            with self.db.transaction():
+                Card.update_where({'description': None}, 'id_card < ?', (3,))
+                Card.delete_where('id_card = ?', (5,))
+        self.assertEqual(metrics.commits, 1)
+        self.assertTrue(all('slow query' in line for line in logs.output))
+        self.assertEqual([v['rows'] for k, v in metrics.stats().items() if k.startswith('UPDATE')], [2])
+        self.db.disable_instrumentation()
+        self.assertIsNone(self.db.instrumentation())
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class ColumnarTest(QueryTest):
+
+    def test_typed_columns(self):
+        columns = Card.fetch_columns(where='id_bank = ?', params=(2,), fields=['id_card', 'description'],
+                                     chunk_size=4)
+        self.assertEqual(list(columns), ['id_card', 'description'])
+        self.assertEqual(columns['id_card'].dtype, numpy.int64)
+        self.assertEqual(columns['id_card'].tolist(), list(range(2, 31, 3)))
+        self.assertEqual(columns['description'][0], 'card 1')
+        self.assertEqual(Card.fetch_columns()['id_bank'].sum(), 60)
+
+    def test_nulls(self):
+        self.db.create_tables([Payment])
+        self.db.bulk_insert(Payment, [{'amount': 1.5, 'id_bank': 1}, {'amount': None, 'id_bank': None}])
+        columns = Payment.fetch_columns(fields=['amount', 'id_bank'])
+        self.assertEqual(columns['amount'].dtype, numpy.float64)
+        # an INTEGER column with NULLs becomes float with NaN
+        self.assertEqual(columns['id_bank'].dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(columns['id_bank'][1]))
+        self.assertEqual(len(Payment.fetch_columns(where='amount > ?', params=(5,))['amount']), 0)
+
+
+class ForeignKeyTest(QueryTest):
+
+    def test_lazy_foreign_key_memo(self):
+        cards = Card().get_all()
+        banks = [c.id_bank.get_object() for c in cards]
+        self.assertEqual([b.get_keys()[0].get_value() for b in banks], [i % 3 + 1 for i in range(30)])
+        # one load per distinct foreign key in a result set
+        self.assertIs(banks[0], banks[3])
+
+    def test_prefetch(self):
+        statements = []
+        self.db.connection().set_trace_callback(statements.append)
+        cards = Card.query().prefetch('id_bank').all()
+        self.assertEqual(cards[4].id_bank.get_object().name.get_value(), 'bank 1')
+        self.assertEqual(len([s for s in statements if s.startswith('SELECT')]), 2)
+        self.assertEqual(Card().get_all(prefetch=['id_bank'])[2].id_bank.get_object().name.get_value(), 'bank 2')
+
+    def test_prefetch_chunks_the_in_list(self):
+        self.db.bulk_insert(Bank, ({'name': 'many ' + str(i)} for i in range(SQL_MAX_VARIABLES * 2)))
+        self.db.bulk_insert(Card, ({'description': 'many ' + str(i), 'id_bank': i + 4}
+                                   for i in range(SQL_MAX_VARIABLES * 2)))
+        statements = []
+        self.db.connection().set_trace_callback(statements.append)
+        cards = Card.query().filter(description__like='many %').prefetch('id_bank').all()
+        self.db.connection().set_trace_callback(None)
+        self.assertEqual(len(cards), SQL_MAX_VARIABLES * 2)
+        self.assertEqual(len([s for s in statements if s.startswith('SELECT')]), 3)
+        self.assertTrue(all(c.id_bank.get_object().name.get_value() == c.description.get_value() for c in cards))
+
+    def test_stream_memo_is_per_batch(self):
+        cards = list(Card().iter_all(batch_size=10))
+        for c in cards:
+            c.id_bank.get_object()
+        self.assertIs(cards[0].id_bank.get_object(), cards[3].id_bank.get_object())
+        self.assertIsNot(cards[0].id_bank.get_object(), cards[12].id_bank.get_object())
+        self.assertIsNot(cards[0]._memos, cards[10]._memos)
+
+
+class ProjectionTest(QueryTest):
+
+    def trace(self):
+        statements = []
+        self.db.connection().set_trace_callback(statements.append)
+        return statements
+
+    def test_only_loads_the_selected_columns(self):
+        statements = self.trace()
+        cards = Card.query().only('description').order_by('id_card').all()
+        self.assertEqual(statements, ['SELECT id_card, description FROM card ORDER BY id_card;'])
+        self.assertEqual(cards[3].description.get_value(), 'card 3')
+        # the deferred column is loaded on its first get_value, the primary key is always there
+        self.assertEqual(cards[3].id_bank.get_value(), 1)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(cards[3].id_bank.get_value(), 1)
+        self.assertEqual(len(statements), 2)
+        records = Card().get_all(fields=['id_bank'], records=True)
+        self.assertEqual(records[4]._fields, ('id_card', 'id_bank'))
+
+    def test_defer(self):
+        statements = self.trace()
+        card = Card.query().defer('description').filter(id_card=5).first()
+        self.assertNotIn('description', statements[0])
+        card.id_bank.set_value(3)
+        card.save()
+        # saving writes the changed column only, the deferred one is left as it is
+        self.assertEqual(Card().get_by_id(5).description.get_value(), 'card 4')
+        self.assertEqual(Card().get_by_id(5).id_bank.get_value(), 3)
+
+
+class DirtyTrackingTest(QueryTest):
+
+    def test_partial_update(self):
+        card = Card().get_by_id(4)
+        self.assertFalse(card.is_dirty())
+        statements = []
+        self.db.connection().set_trace_callback(statements.append)
+        self.assertTrue(card.save())
+        self.assertEqual(statements, [])
+        card.description.set_value('renamed')
+        self.assertTrue(card.is_dirty())
+        self.assertTrue(card.save())
+        self.assertEqual([s for s in statements if s.startswith('UPDATE')],
+                         ["UPDATE card SET description = 'renamed' WHERE id_card = 4;"])
+        self.assertFalse(card.is_dirty())
+        self.assertEqual(Card().get_by_id(4).description.get_value(), 'renamed')
+
+    def test_new_objects_are_dirty_until_saved(self):
+        card = Card()
+        self.assertTrue(card.is_dirty())
+        card.description.set_value('new')
+        card.id_bank.set_value(2)
+        self.assertTrue(card.save())
+        self.assertFalse(card.is_dirty())
+        self.assertEqual(card.id_card.get_value(), 31)
+
+class AggregateTest(QueryTest):
+
+    def test_scalars(self):
+        self.assertEqual(Card.count(), 30)
+        self.assertEqual(Card.count('id_bank = ?', (1,)), 10)
+        self.assertEqual(Card.sum('id_card', 'id_bank = ?', (3,)), sum(range(3, 31, 3)))
+        self.assertEqual(Card.avg('id_card'), 15.5)
+        self.assertEqual((Card.min('id_card'), Card.max('description')), (1, 'card 9'))
+        self.assertTrue(Card.exists('description = ?', ('card 7',)))
+        self.assertFalse(Card.query().filter(id_card__gt=30).exists())
+        self.assertIsNone(Card.query().filter(id_card__gt=30).max('id_card'))
+        # LIMIT/OFFSET are applied before aggregating
+        self.assertEqual(Card.query().order_by('-id_card').limit(5).sum('id_card'), 26 + 27 + 28 + 29 + 30)
+
+    def test_group_by(self):
+        self.assertEqual(Card.group_by('id_bank').aggregate('count', 'id_card__max'),
+                         [(1, 10, 28), (2, 10, 29), (3, 10, 30)])
+        self.assertEqual(Card.query().filter(id_card__lte=4).group_by('id_bank').order_by('-id_bank').aggregate(),
+                         [(3, 1), (2, 1), (1, 2)])
+        self.assertEqual(Card.query().aggregate('count', 'id_card__min'), (30, 1))
+        with self.assertRaises(EdgeModelException):
+            Card.group_by('id_bank').aggregate('id_card__median')
+
+    def test_count_is_one_statement(self):
+        statements = []
+        self.db.connection().set_trace_callback(statements.append)
+        Card.count('id_bank = ?', (2,))
+        self.assertEqual(statements, ['SELECT COUNT(*) FROM card WHERE (id_bank = 2);'])
+
+
+class CacheTest(QueryTest):
+
+    def setUp(self):
+        QueryTest.setUp(self)
+        self.db.enable_cache(64)
+
+    def description(self, key):
+        return Card().get_by_id(key).description.get_value()
+
+    def test_hits(self):
+        self.description(1)
+        self.description(1)
+        self.assertEqual((self.db.cache().stats()['hits'], self.db.cache().stats()['misses']), (1, 1))
+
+    def test_save_and_delete_refresh_the_cache(self):
+        card = Card().get_by_id(1)
+        card.description.set_value('renamed')
+        card.save()
+        self.assertEqual(self.description(1), 'renamed')
+        Card().get_by_id(2).delete()
+        self.assertIsNone(Card().get_by_id(2))
+
+    def test_update_where_and_bulk_insert_invalidate(self):
+        self.description(1)
+        Bank().get_by_id(1)
+        Card.update_where({'description': 'bulk'}, 'id_card = ?', (1,))
+        self.assertEqual(self.description(1), 'bulk')
+        self.db.bulk_insert(Card, [{'description': 'card 30', 'id_bank': 1}])
+        # only the rows of the written model are dropped
+        self.assertEqual(self.db.cache().stats()['size'], 1)
+        self.assertEqual(self.description(31), 'card 30')
+
+    def test_rollback_drops_rows_cached_inside_the_block(self):
+        self.description(1)
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                card = Card().get_by_id(1)
+                card.description.set_value('rolled back')
+                card.save()
+                self.assertEqual(self.description(1), 'rolled back')
+                raise ValueError()
+        self.assertEqual(self.description(1), 'card 0')
+
+
+class SetWriteTest(QueryTest):
+
+    def setUp(self):
+        QueryTest.setUp(self)
+        self.db.enable_cache(64)
+
+    def test_update_where_keeps_cache_coherent(self):
+        self.assertEqual(Card().get_by_id(1).description.get_value(), 'card 0')
+        self.assertEqual(Card.update_where({'description': 'renamed'}, 'id_card = ?', (1,)), 1)
+        self.assertEqual(Card().get_by_id(1).description.get_value(), 'renamed')
+        self.assertEqual(Card.update_where({'id_bank': Bank().get_by_id(3)}, 'id_bank = ?', (1,)), 10)
+        self.assertEqual(Card.count('id_bank = ?', (3,)), 20)
+
+    def test_delete_where(self):
+        self.assertEqual(Card.delete_where('id_card > ?', (20,)), 10)
+        self.assertEqual(Card.query().filter(id_bank=1).order_by('-id_card').limit(2).delete(), 2)
+        self.assertEqual(Card.count(), 18)
+        self.assertIsNone(Card().get_by_id(30))
+
+    def test_unfiltered_writes_need_all(self):
+        with self.assertRaises(EdgeModelException):
+            Card.delete_where()
+        with self.assertRaises(EdgeModelException):
+            Card.update_where({'description': None})
+        with self.assertRaises(EdgeModelException):
+            Card.query().delete()
+        self.assertEqual(Card.count(), 30)
+        self.assertEqual(Card.update_where({'description': None}, all=True), 30)
+        self.assertEqual(Card.delete_where(all=True), 30)
+
+
+class Note(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'note'
+        self.id_note = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_note')
+        self.title = TextField(FullText, FieldName='title')
+        self.body = TextField(FullText, FieldName='body')
+        self.pinned = IntegerField(FieldName='pinned')
+
+
+class Transfer(EdgeModel):
+
+    def __define_model__(self):
+        self.table_name = 'transfer'
+        self.id_transfer = IntegerField(PrimaryKey, AutoIncrement, FieldName='id_transfer')
+        self.amount = RealField(Indexed, FieldName='amount')
+        self.kind = TextField(FieldName='kind')
+        self.reference = TextField(FieldName='reference')
+        self.id_bank = IntegerField(ForeignModel=Bank, FieldName='id_bank')
+        self.by_kind = Index('kind', '-amount', Where='kind IS NOT NULL')
+        self.by_reference = Index('id_bank', 'reference', Unique=True, Name='transfer_reference')
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Bank, Transfer])
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_declared_indexes(self):
+        rows = self.db.connection().execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND "
+                                            "tbl_name = 'transfer' AND sql IS NOT NULL ORDER BY name;").fetchall()
+        self.assertEqual([r[0] for r in rows], ['idx_transfer_amount', 'idx_transfer_by_kind', 'idx_transfer_id_bank',
+                                                'transfer_reference'])
+        self.assertIn('(kind, amount DESC) WHERE kind IS NOT NULL', rows[1][1])
+        self.assertTrue(rows[3][1].startswith('CREATE UNIQUE INDEX'))
+        # create_tables can run again on an existing schema
+        self.db.create_tables([Transfer])
+
+    def test_query_plan_check(self):
+        self.db.set_query_plan_check(True)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            Transfer.count('amount > ?', (1,))
+            Transfer.query().filter(id_bank=1).all()
+            Transfer.query().filter(kind='fee').order_by('-amount').all()
+            self.assertEqual(len(caught), 0)
+            Transfer.query().filter(reference='x').all()
+            Transfer.query().filter(reference='x').all()
+        self.assertEqual(len(caught), 1)
+        self.assertIs(caught[0].category, QueryPlanWarning)
+        self.assertIn('SCAN transfer', str(caught[0].message))
+
+
+class FullTextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Note])
+        self.db.bulk_insert(Note, [{'title': 'red apple', 'body': 'fruit salad'},
+                                   {'title': 'green pear', 'body': 'apple pie'},
+                                   {'title': 'blue sky', 'body': 'weather'}])
+
+    def tearDown(self):
+        self.db.close()
+
+    def found(self, text):
+        return sorted(n.id_note.get_value() for n in Note.search(text))
+
+    def assertInSync(self):
+        # raises when the external content index and the table disagree
+        self.db.connection().execute("INSERT INTO note_fts(note_fts) VALUES('integrity-check');")
+
+    def test_search(self):
+        self.assertEqual(self.found('apple'), [1, 2])
+        self.assertEqual(self.found('title: apple'), [1])
+        self.assertEqual(self.found('pea*'), [2])
+        self.assertEqual([r.title for r in Note.search('apple', limit=1, records=True)], ['red apple'])
+        with self.assertRaises(EdgeModelException):
+            Bank.search('apple')
+
+    def test_updates_stay_in_sync(self):
+        note = Note().get_by_id(3)
+        note.title.set_value('apple sky')
+        note.save()
+        self.assertEqual(self.found('apple'), [1, 2, 3])
+        self.assertEqual(self.found('blue'), [])
+        Note.update_where({'body': 'cloudy'}, 'id_note = ?', (2,))
+        self.assertEqual(self.found('pie'), [])
+        self.assertEqual(self.found('cloudy'), [2])
+        # only non indexed columns change, the index keeps its rows
+        Note.update_where({'pinned': 1}, all=True)
+        self.assertEqual(self.found('apple'), [1, 3])
+        replaced = Note()
+        replaced.id_note.set_value(1)
+        replaced.title.set_value('plum')
+        replaced.save()
+        self.assertEqual(self.found('apple'), [3])
+        self.assertEqual(self.found('plum'), [1])
+        self.assertInSync()
+
+    def test_deletes_stay_in_sync(self):
+        Note().get_by_id(1).delete()
+        self.assertEqual(self.found('apple'), [2])
+        Note.delete_where('id_note = ?', (2,))
+        self.assertEqual(self.found('apple'), [])
+        self.assertEqual(self.found('sky'), [3])
+        self.assertInSync()
+
+
+class PageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Bank, Payment])
+        self.db.bulk_insert(Payment, ({'amount': None if i % 4 == 0 else float(i % 7), 'note': 'p' + str(i)}
+                                      for i in range(20)))
+
+    def tearDown(self):
+        self.db.close()
+
+    def pages(self, order_by):
+        keys, after = [], None
+        while True:
+            rows, after = Payment.page(after, limit=3, order_by=order_by)
+            keys.extend(p.id_payment.get_value() for p in rows)
+            if after is None:
+                return keys
+
+    def test_nullable_order_column(self):
+        for order_by in ('amount', '-amount'):
+            keys = self.pages(order_by)
+            self.assertEqual(sorted(keys), list(range(1, 21)), order_by)
+            self.assertEqual(keys, [r[0] for r in self.db.connection().execute(
+                'SELECT id_payment FROM payment ORDER BY amount' + (' DESC' if order_by.startswith('-') else '') +
+                ', id_payment' + (' DESC' if order_by.startswith('-') else '') + ';')])
+
+    def test_primary_key_pages(self):
+        pages, after = [], None
+        while True:
+            rows, after = Payment.page(after, limit=5)
+            pages.append([p.id_payment.get_value() for p in rows])
+            if after is None:
+                break
+        # a full last page already returns no cursor instead of an empty extra page
+        self.assertEqual(pages, [list(range(i, i + 5)) for i in range(1, 21, 5)])
+
+    def test_filtered_query_pages(self):
+        q = Payment.query().filter(amount__gte=3.0)
+        rows, after = q.page(limit=4, order_by='-amount')
+        self.assertEqual([p.amount.get_value() for p in rows], [6.0, 6.0, 5.0, 5.0])
+        rest, after = q.page(after, limit=10, order_by='-amount')
+        self.assertIsNone(after)
+        self.assertEqual(len(rows) + len(rest), q.count())
+        self.assertEqual(Payment.query().filter(amount__gt=100.0).page(limit=3), ([], None))
+
+
+class ImportExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Bank, Payment])
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_csv_round_trip_keeps_nulls(self):
+        self.db.bulk_insert(Payment, [{'amount': None, 'note': None}, {'amount': 2.5, 'note': 'x'}])
+        out = io.StringIO()
+        self.assertEqual(Payment.export(out), 2)
+        Payment.delete_where(all=True)
+        self.assertEqual(self.db.import_rows(Payment, io.StringIO(out.getvalue())), 2)
+        rows = sorted(Payment().get_all(records=True))
+        self.assertEqual([(r.amount, r.note) for r in rows], [(None, None), (2.5, 'x')])
+
+
+class ImportErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.db.open(':memory:')
+        self.db.create_tables([Bank, Payment])
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_bad_csv_cell_reports_line_and_keeps_nothing(self):
+        source = io.StringIO('amount,note\n' + ''.join('1.5,n%d\n' % i for i in range(10)) + 'oops,bad\n1.0,x\n')
+        with self.assertRaises(EdgeModelException) as raised:
+            self.db.import_rows(Payment, source, chunk_size=3)
+        self.assertIn('line 12', str(raised.exception))
+        self.assertEqual(Payment.count(), 0)
+
+    def test_bad_jsonl_line(self):
+        source = io.StringIO('{"note": "a"}\n{"note": \n')
+        with self.assertRaises(EdgeModelException) as raised:
+            self.db.import_rows(Payment, source, format='jsonl')
+        self.assertIn('line 2', str(raised.exception))
+        self.assertEqual(Payment.count(), 0)
+
+    def test_constraint_error(self):
+        source = io.StringIO('name\nx\ny\nx\n')
+        with self.assertRaises(EdgeModelException):
+            self.db.import_rows(Bank, source, chunk_size=2)
+        self.assertEqual(Bank.count(), 0)
+
+
+class FileDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='edgemodel-test-')
+        self.path = os.path.join(self.workdir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class PoolTest(FileDatabaseTest):
+
+    def setUp(self):
+        FileDatabaseTest.setUp(self)
+        self.db = Database()
+        self.db.open(self.path, True, pool_size=1)
+        self.db.create_tables([Bank, Card])
+        self.db.bulk_insert(Bank, ({'name': 'bank ' + str(i)} for i in range(3)))
+        self.db.bulk_insert(Card, ({'description': 'card ' + str(i), 'id_bank': i % 3 + 1} for i in range(10)))
+
+    def tearDown(self):
+        self.db.close()
+        FileDatabaseTest.tearDown(self)
+
+    def test_lazy_foreign_key_inside_iteration(self):
+        names = run_with_timeout(self, lambda: [c.id_bank.get_object().name.get_value()
+                                                for c in Card().iter_all(batch_size=3)])
+        self.assertEqual(len(names), 10)
+        self.assertEqual(names[0], 'bank 0')
+
+    def test_prefetch_inside_iteration(self):
+        cards = run_with_timeout(self, lambda: list(Card.query().prefetch('id_bank').iter(batch_size=3)))
+        self.assertEqual([c.id_bank.get_object().get_keys()[0].get_value() for c in cards],
+                         [i % 3 + 1 for i in range(10)])
+        self.assertEqual(self.db.pool_stats()['idle'], 1)
+
+    def test_closed_iterator_returns_the_reader(self):
+        iterator = Card().iter_all(batch_size=2)
+        self.assertEqual(next(iterator).description.get_value(), 'card 0')
+        iterator.close()
+        self.assertEqual(self.db.pool_stats()['idle'], 1)
+        # another thread needs the only pooled connection
+        self.assertEqual(run_with_timeout(self, Card.count), 10)
+
+    def test_concurrent_readers_and_writers(self):
+        errors, counts = [], []
+
+        def write(n):
+            try:
+                for i in range(25):
+                    if not new_bank('writer ' + str(n) + ' ' + str(i)).save():
+                        errors.append('save failed')
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                for _ in range(25):
+                    counts.append(Bank.count())
+                    self.assertEqual(len(Card().get_all()), 10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        threads += [threading.Thread(target=read) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEqual(errors, [])
+        self.assertEqual(Bank.count(), 103)
+        self.assertTrue(all(3 <= c <= 103 for c in counts))
+        self.assertEqual(self.db.pool_stats()['idle'], 1)
+
+    def test_readers_wait_for_a_free_connection(self):
+        held, done = threading.Event(), []
+
+        def hold():
+            with self.db.reader():
+                held.set()
+                time.sleep(0.1)
+
+        t = threading.Thread(target=hold)
+        t.start()
+        held.wait(30)
+        done.append(run_with_timeout(self, Bank.count))
+        t.join(30)
+        self.assertEqual(done, [3])
+        self.assertGreaterEqual(self.db.pool_stats()['waits'], 1)
+        self.assertEqual(self.db.pool_stats()['created'], 1)
+
+    def test_transaction_reads_its_own_writes(self):
+        seen = []
+        with self.db.transaction():
+            new_bank('uncommitted').save()
+            self.assertEqual(Bank.count(), 4)
+            t = threading.Thread(target=lambda: seen.append(Bank.count()))
+            t.start()
+            t.join(30)
+        # other threads read the last committed state through the pool
+        self.assertEqual(seen, [3])
+        self.assertEqual(Bank.count(), 4)
+
+    def test_query_plan_check_from_reader_threads(self):
+        self.db.set_query_plan_check(True)
+        results = []
+
+        def count():
+            for _ in range(20):
+                results.append(Card.count('id_card + 0 = ?', (1,)))
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            threads = [threading.Thread(target=count) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(30)
+        self.db.set_query_plan_check(False)
+        self.assertEqual(results, [1] * 160)
+        self.assertEqual(len([w for w in caught if issubclass(w.category, QueryPlanWarning)]), 1)
+
+
+class ProfileTest(FileDatabaseTest):
+
+    def tearDown(self):
+        self.db.close()
+        FileDatabaseTest.tearDown(self)
+
+    def test_profile_pragmas(self):
+        self.db = Database()
+        self.db.open(self.path, True, profile='bulk_load')
+        self.assertEqual(self.db.profile(), 'bulk_load')
+        self.assertEqual(self.db.pragmas()['journal_mode'], 'memory')
+        self.assertEqual(self.db.pragmas()['synchronous'], 0)
+        self.assertTrue(self.db.set_profile({'cache_size': -4096}))
+        self.assertEqual(self.db.profile(), 'custom')
+        self.assertEqual(self.db.pragmas()['cache_size'], -4096)
+        self.assertEqual(self.db.skipped_pragmas(), {})
+        with self.assertRaises(EdgeModelException):
+            self.db.set_profile('fastest')
+
+    def test_pooled_database_reports_skipped_journal_mode(self):
+        self.db = Database()
+        self.db.open(self.path, True, pool_size=2)
+        self.assertTrue(self.db.set_profile('bulk_load'))
+        self.assertEqual(self.db.skipped_pragmas(), {'journal_mode': 'MEMORY'})
+        self.assertEqual(self.db.pragmas()['journal_mode'], 'wal')
+        self.assertEqual(self.db.pragmas()['synchronous'], 0)
+        self.assertTrue(self.db.set_profile('read_heavy'))
+        self.assertEqual(self.db.skipped_pragmas(), {})
+
+    def test_maintenance(self):
+        self.db = Database()
+        self.db.open(self.path, True)
+        # auto_vacuum only changes before the file is switched to WAL
+        with self.db.writer() as conn:
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+        self.db.set_profile('durable')
+        self.db.create_tables([Bank, Card])
+        self.db.bulk_insert(Bank, [{'name': 'bank'}])
+        self.db.bulk_insert(Card, ({'description': 'card ' * 50 + str(i), 'id_bank': 1} for i in range(2000)))
+        Card.delete_where(all=True)
+        self.assertTrue(self.db.run_maintenance())
+        stats = self.db.maintenance_stats()
+        self.assertEqual(stats['runs'], 1)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['checkpoints'], 1)
+        self.assertGreater(stats['vacuumed_pages'], 0)
+        self.assertEqual(self.db.pragmas()['freelist_count'], 0)
+        self.db.start_maintenance(interval=0.05)
+        with self.assertRaises(EdgeModelException):
+            self.db.start_maintenance()
+        deadline = time.time() + 30
+        while self.db.maintenance_stats()['runs'] < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.db.maintenance_stats()['running'])
+        self.db.stop_maintenance()
+        self.assertFalse(self.db.maintenance_stats()['running'])
+        self.assertGreaterEqual(self.db.maintenance_stats()['runs'], 3)
+
+
+def card_keys(cards):
+    # module level so the worker processes can unpickle it
+    return [c.id_card.get_value() for c in cards]
+
+
+def record_banks(records):
+    return [r.id_bank for r in records]
+
+
+class ParallelScanTest(FileDatabaseTest):
+
+    def setUp(self):
+        FileDatabaseTest.setUp(self)
+        self.db = Database()
+        self.db.open(self.path, True)
+        self.db.create_tables([Bank, Card])
+        self.db.bulk_insert(Bank, ({'name': 'bank ' + str(i)} for i in range(3)))
+        self.db.bulk_insert(Card, ({'description': 'card ' + str(i), 'id_bank': i % 3 + 1} for i in range(50)))
+
+    def tearDown(self):
+        self.db.close()
+        FileDatabaseTest.tearDown(self)
+
+    def test_partitions(self):
+        keys = Card.parallel_scan(card_keys, workers=2, chunk_size=8, reduce=operator.add)
+        self.assertEqual(keys, list(range(1, 51)))
+        # one result per rowid range when there is no reduce
+        parts = Card.parallel_scan(card_keys, workers=2, chunk_size=20, where='id_bank = ?', params=(1,))
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(sum(parts, []), list(range(1, 51, 3)))
+        banks = Card.parallel_scan(record_banks, workers=2, chunk_size=20, records=True, reduce=operator.add)
+        self.assertEqual(banks, [i % 3 + 1 for i in range(50)])
+
+    def test_empty_table_and_memory_database(self):
+        Card.delete_where(all=True)
+        self.assertIsNone(Card.parallel_scan(card_keys, reduce=operator.add))
+        self.assertEqual(Card.parallel_scan(card_keys), [])
+        memory = Database()
+        memory.open(':memory:')
+        memory.create_tables([Card])
+        with self.assertRaises(EdgeModelException):
+            Card.parallel_scan(card_keys)
+        memory.close()
+
+
+class AsyncIteratorTest(FileDatabaseTest):
+
+    def test_more_iterators_than_workers(self):
+        # every aiter keeps its cursor open across awaits, they must not starve the worker pool
+        db = AsyncDatabase(workers=2)
+        db.open(self.path, True)
+        db.create_tables([Bank])
+        db.bulk_insert(Bank, ({'name': 'bank ' + str(i)} for i in range(20)))
+
+        async def consume():
+            return [b.name.get_value() async for b in Bank.aiter(batch_size=2)]
+
+        async def main():
+            return await asyncio.gather(*[consume() for _ in range(6)])
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(asyncio.run(main())), daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), 'aiter loops deadlocked')
+        self.assertEqual(len(results[0]), 6)
+        for names in results[0]:
+            self.assertEqual(len(names), 20)
+        db.close()
+
+
+
+class AsyncModelTest(FileDatabaseTest):
+
+    def setUp(self):
+        FileDatabaseTest.setUp(self)
+        self.db = AsyncDatabase(workers=2)
+        self.db.open(self.path, True)
+        self.db.create_tables([Bank])
+
+    def tearDown(self):
+        self.db.close()
+        FileDatabaseTest.tearDown(self)
+
+    def run_async(self, coro):
+        return run_with_timeout(self, lambda: asyncio.run(coro))
+
+    def test_concurrent_writes_share_a_transaction(self):
+        instrumentation = self.db.instrument()
+
+        async def main():
+            return await asyncio.gather(*[new_bank('bank ' + str(i)).asave() for i in range(20)])
+
+        self.assertEqual(self.run_async(main()), [True] * 20)
+        self.assertEqual(instrumentation.commits, 1)
+        self.assertEqual(Bank.count(), 20)
+
+    def test_failed_write_rolls_back_alone(self):
+        def fail():
+            new_bank('failed').save()
+            raise ValueError()
+
+        async def main():
+            return await asyncio.gather(new_bank('kept').asave(), self.db.run_write(fail),
+                                        return_exceptions=True)
+
+        saved, error = self.run_async(main())
+        self.assertTrue(saved)
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual([b.name.get_value() for b in Bank().get_all()], ['kept'])
+
+    def test_reads_and_delete(self):
+        self.db.bulk_insert(Bank, ({'name': 'bank ' + str(i)} for i in range(3)))
+
+        async def main():
+            bank = Bank()
+            bank.id_bank.set_value(2)
+            loaded = await bank.aload()
+            deleted = await bank.adelete()
+            return loaded, bank.name.get_value(), deleted, await Bank.aget_all(records=True)
+
+        loaded, name, deleted, rows = self.run_async(main())
+        self.assertEqual((loaded, name, deleted), (True, 'bank 1', True))
+        self.assertEqual([r.name for r in rows], ['bank 0', 'bank 2'])
+
+
+
+class BenchmarkTest(FileDatabaseTest):
+
+    SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'bench_edgemodel.py')
+
+    def test_smoke_run(self):
+        # tiny sizes, only checks the suite still runs against the current API
+        output = os.path.join(self.workdir, 'bench.json')
+        subprocess.run([sys.executable, self.SCRIPT, '--sizes', '20', '--db', 'memory,file', '--no-memory',
+                        '--output', output], check=True, capture_output=True, timeout=120)
+        with open(output) as f:
+            results = json.load(f)['results']
+        self.assertEqual(len(results), 26)
+        self.assertTrue(all(r['ops_per_sec'] > 0 for r in results))
+        run = subprocess.run([sys.executable, self.SCRIPT, '--sizes', '20', '--db', 'memory', '--only', 'load',
+                              '--no-memory', '--compare', output], check=True, capture_output=True, text=True,
+                             timeout=120)
+        self.assertEqual([r['name'] for r in json.loads(run.stdout)['results']], ['load'])
+        self.assertIn(' -> ', run.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()